@@ -1,7 +1,19 @@
 import pytest
-from vsdx import VisioFile, namespace, vt_namespace, ext_prop_namespace, PagePosition
+import vsdx
+import vsdx.__main__ as vsdx_main
+from vsdx import VisioFile, namespace, vt_namespace, ext_prop_namespace, PagePosition, compile_jinja_expression
+from vsdx import JinjaRenderer, RenderCache, ReadOnlyError, AsyncVisioFile, AsyncConfig
 from datetime import datetime
 import os
+import tempfile
+import io
+import csv
+import json
+import asyncio
+import zipfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import xml.etree.ElementTree as ET
 from typing import List
 
 basedir = os.path.relpath(__file__)[:-7]  # remove last 7 chars to get directory
@@ -9,14 +21,224 @@ basedir = os.path.relpath(__file__)[:-7]  # remove last 7 chars to get directory
 
 def test_file_closure():
     filename = basedir+'test1.vsdx'
-    directory = f"./{filename.rsplit('.', 1)[0]}"
-    with VisioFile(filename):
+    with VisioFile(filename) as vis:
+        directory = vis.directory
         # confirm directory exists
         assert os.path.exists(directory)
     # confirm directory is gone
     assert not os.path.exists(directory)
 
 
+@pytest.mark.parametrize("data", [b"not a zip file", b""])
+def test_file_open_invalid(data: bytes, monkeypatch):
+    # private directory is removed when file can't be opened
+    temp_dir = basedir+'out'+ os.sep + 'test_file_open_invalid'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    filename = temp_dir + os.sep + 'broken.vsdx'
+    with open(filename, 'wb') as f:
+        f.write(data)
+    monkeypatch.setattr(tempfile, 'tempdir', temp_dir)
+    with pytest.raises(zipfile.BadZipFile):
+        VisioFile(filename)
+    assert os.listdir(temp_dir) == ['broken.vsdx']
+
+
+@pytest.mark.parametrize("filename", ["test1.vsdx", "test_jinja.vsdx"])
+def test_file_concurrent_use(filename: str):
+    # each VisioFile has a private directory, so the same file can be opened and saved at the same time
+    def save_copy(i: int):
+        out_file = basedir+'out'+ os.sep + filename[:-5] + f'_test_file_concurrent_use_{i}.vsdx'
+        with VisioFile(basedir+filename) as vis:
+            vis.pages[0].set_name(f"Page {i}")
+            vis.save_vsdx(out_file)
+        with VisioFile(out_file) as vis:
+            return vis.pages[0].name
+
+    os.makedirs(basedir+'out', exist_ok=True)
+    with VisioFile(basedir+filename) as vis:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert list(executor.map(save_copy, range(8))) == [f"Page {i}" for i in range(8)]
+        assert os.path.exists(vis.directory)  # not removed when other VisioFile objects closed
+
+
+@pytest.mark.parametrize("filename, shape_ids", [("test2.vsdx", ["6", "1", "8", "14", "17"]),
+                                                  ("test4_connectors.vsdx", ["1", "2", "5", "6", "7"])])
+def test_read_only(filename: str, shape_ids: list):
+    with VisioFile(basedir+filename) as vis:
+        page = vis.pages[0]  # type: VisioFile.Page
+        expected = [(page.find_shape_by_id(i).text, [s.ID for s in page.find_shape_by_id(i).connected_shapes])
+                    for i in shape_ids]
+        assert vis.freeze() is vis
+
+        def query(shape_id: str):
+            shape = page.find_shape_by_id(shape_id)
+            return shape.text, [s.ID for s in shape.connected_shapes]
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert list(executor.map(query, shape_ids * 10)) == expected * 10
+        assert page.shapes is page.shapes  # shapes built once
+
+        shape = page.find_shape_by_id(shape_ids[0])
+        with pytest.raises(ReadOnlyError):
+            shape.text = "changed"
+        with pytest.raises(ReadOnlyError):
+            shape.x = 1
+        with pytest.raises(ReadOnlyError):
+            page.set_name("changed")
+        with pytest.raises(ReadOnlyError):
+            vis.add_page()
+        with pytest.raises(ReadOnlyError):
+            vis.copy_shape(shape.xml, page.xml, page.filename)
+        with pytest.raises(ReadOnlyError):
+            vis.insert_shape(ET.fromstring(ET.tostring(shape.xml)), page.xml.getroot(), page.xml, page.filename)
+        with pytest.raises(ReadOnlyError):
+            page.max_id += 1
+        with pytest.raises(ReadOnlyError):
+            JinjaRenderer(vis)
+        with pytest.raises(ReadOnlyError):
+            vis.save_vsdx(basedir+'out'+ os.sep + filename[:-5] + '_test_read_only.vsdx')
+        assert shape.text == expected[0][0] and len(vis.pages) == len(vis.pages_xml.getroot())
+
+        # a clone can be changed
+        with vis.clone() as vis_copy:
+            vis_copy.pages[0].find_shape_by_id(shape_ids[0]).text = "changed"
+            assert vis_copy.pages[0].find_shape_by_id(shape_ids[0]).text == "changed"
+
+
+@pytest.mark.parametrize("filename, workers, compression, compresslevel",
+                         [("test1.vsdx", None, zipfile.ZIP_DEFLATED, None), ("test2.vsdx", 4, zipfile.ZIP_DEFLATED, 9),
+                          ("test3_house.vsdx", 1, zipfile.ZIP_DEFLATED, 1), ("test4_connectors.vsdx", 2, zipfile.ZIP_STORED, None)])
+def test_save_compression(filename: str, workers: int, compression: int, compresslevel: int):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_save_compression.vsdx'
+    with VisioFile(basedir+filename) as vis:
+        page_xml = [ET.tostring(p.xml.getroot()) for p in vis.pages]
+        os.makedirs(vis.directory + '/visio/media')
+        with open(vis.directory + '/visio/media/image1.png', 'wb') as f:
+            f.write(bytes(1000))  # media file, which is stored whatever the compression
+        vis.save_vsdx(out_file, workers=workers, compression=compression, compresslevel=compresslevel)
+
+    with zipfile.ZipFile(basedir+filename) as source, zipfile.ZipFile(out_file) as saved:
+        assert saved.testzip() is None
+        assert saved.namelist()[0] == '[Content_Types].xml'
+        assert sorted(saved.namelist()) == sorted([n for n in source.namelist() if not n.endswith('/')] +
+                                                  ['visio/media/image1.png'])
+        for info in saved.infolist():
+            media = info.filename.endswith('.png')
+            assert info.compress_type == (zipfile.ZIP_STORED if media else compression)
+            if not info.filename.endswith(('.xml', '.rels', '.png')):  # binary part from source file
+                assert saved.read(info) == source.read(info.filename)
+    with VisioFile(out_file) as vis:
+        assert [ET.tostring(p.xml.getroot()) for p in vis.pages] == page_xml
+        with pytest.raises(ValueError):
+            vis.save_vsdx(out_file, compression=zipfile.ZIP_LZMA)
+
+
+@pytest.mark.parametrize("filename", ["test1.vsdx", "test4_connectors.vsdx"])
+def test_save_media_passthrough(filename: str):
+    media_file = basedir+'out'+ os.sep + filename[:-5] + '_test_save_media_passthrough.vsdx'
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_save_media_passthrough_out.vsdx'
+    os.makedirs(basedir+'out', exist_ok=True)
+    shutil.copy(basedir+filename, media_file)
+    with zipfile.ZipFile(media_file, 'a') as z:
+        z.writestr('visio/media/image1.emf', os.urandom(1000) + bytes(100000), zipfile.ZIP_DEFLATED)
+        z.writestr('visio/media/image2.png', os.urandom(5000), zipfile.ZIP_STORED)
+        z.writestr('visio/embeddings/oleObject1.bin', os.urandom(5000), zipfile.ZIP_STORED)
+
+    with VisioFile(media_file) as vis:
+        # binary parts are not extracted
+        assert not os.path.exists(vis.directory + '/visio/media')
+        assert not os.path.exists(vis.directory + '/docProps/thumbnail.emf')
+        vis.pages[0].set_name('Renamed')
+        vis.save_vsdx(out_file)
+
+    with zipfile.ZipFile(media_file) as source, zipfile.ZipFile(out_file) as saved:
+        assert saved.testzip() is None
+        for name, compress_type in [('docProps/thumbnail.emf', zipfile.ZIP_DEFLATED),
+                                    ('visio/media/image1.emf', zipfile.ZIP_DEFLATED),
+                                    ('visio/media/image2.png', zipfile.ZIP_STORED),
+                                    ('visio/embeddings/oleObject1.bin', zipfile.ZIP_DEFLATED)]:
+            source_info, saved_info = source.getinfo(name), saved.getinfo(name)
+            assert (saved_info.compress_type, saved_info.CRC) == (compress_type, source_info.CRC)
+            if source_info.compress_type == compress_type:  # compressed data copied unchanged
+                assert saved_info.compress_size == source_info.compress_size
+            assert saved.read(name) == source.read(name)
+    with VisioFile(out_file) as vis:
+        assert vis.pages[0].name == 'Renamed'
+
+
+@pytest.mark.parametrize("raw_zip_versions", [vsdx.raw_zip_versions, ((2, 0), (2, 7))])
+def test_save_recompress_passthrough(raw_zip_versions: tuple, monkeypatch):
+    # part stored in source file is compressed at the requested level when saved
+    media_file = basedir+'out'+ os.sep + 'test1_test_save_recompress_passthrough.vsdx'
+    os.makedirs(basedir+'out', exist_ok=True)
+    shutil.copy(basedir+'test1.vsdx', media_file)
+    with zipfile.ZipFile(media_file, 'a') as z:
+        z.writestr('visio/embeddings/oleObject1.bin', bytes(100000), zipfile.ZIP_STORED)
+    monkeypatch.setattr(vsdx, 'raw_zip_versions', raw_zip_versions)
+
+    sizes = list()
+    for compresslevel in [0, 9]:
+        out_file = basedir+'out'+ os.sep + f'test1_test_save_recompress_passthrough_{compresslevel}.vsdx'
+        with VisioFile(media_file) as vis:
+            vis.save_vsdx(out_file, compresslevel=compresslevel)
+        with zipfile.ZipFile(out_file) as saved:
+            info = saved.getinfo('visio/embeddings/oleObject1.bin')
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert saved.read(info) == bytes(100000)
+            sizes.append(info.compress_size)
+    assert sizes[0] > 100000 > 1000 > sizes[1]  # level 0 deflate is larger than data, level 9 much smaller
+
+
+@pytest.mark.parametrize("filename, compression", [("test1.vsdx", zipfile.ZIP_DEFLATED),
+                                                     ("test3_house.vsdx", zipfile.ZIP_STORED)])
+def test_save_without_raw_zip_access(filename: str, compression: int, monkeypatch):
+    # private zipfile internals not used, so parts are written with the public zipfile API
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_save_without_raw_zip_access.vsdx'
+    monkeypatch.setattr(vsdx, 'raw_zip_versions', ((2, 0), (2, 7)))  # not tested on this Python version
+    with VisioFile(basedir+filename, pages=[0]) as vis:
+        page_xml = ET.tostring(vis.pages[0].xml.getroot())  # other pages left in source file
+        vis.save_vsdx(out_file, compression=compression, compresslevel=9)
+
+    with zipfile.ZipFile(basedir+filename) as source, zipfile.ZipFile(out_file) as saved:
+        assert saved.testzip() is None
+        assert sorted(saved.namelist()) == sorted(n for n in source.namelist() if not n.endswith('/'))
+        for info in saved.infolist():
+            assert info.compress_type == compression
+            if not info.filename.endswith(('.xml', '.rels')):
+                assert saved.read(info) == source.read(info.filename)
+    with VisioFile(out_file) as vis:
+        assert ET.tostring(vis.pages[0].xml.getroot()) == page_xml
+
+
+@pytest.mark.parametrize("filename, pages, loaded_pages", [("test2.vsdx", ["Page-3"], [2]), ("test2.vsdx", [0, 2], [0, 2]),
+                                                            ("test_master.vsdx", ["Page-1"], [0])])
+def test_open_selected_pages(filename: str, pages: list, loaded_pages: list):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_open_selected_pages.vsdx'
+    with VisioFile(basedir+filename) as vis:
+        expected = [(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages]
+
+    with VisioFile(basedir+filename, pages=pages) as vis:
+        assert [i for i, p in enumerate(vis.pages) if p._xml is not None] == loaded_pages
+        assert [os.path.exists(p.filename) for p in vis.pages] == [i in loaded_pages for i in range(len(vis.pages))]
+        master_ids = set(s.master_page_ID for s in vis.pages[loaded_pages[0]].shapes[0].sub_shapes())
+        assert all(m._xml is not None for m in vis.master_pages if m.name in master_ids)
+        vis.pages[loaded_pages[0]].shapes[0].sub_shapes()[0].x = 1.25
+        vis.save_vsdx(out_file)
+
+    expected[loaded_pages[0]] = None
+    with zipfile.ZipFile(basedir+filename) as source, zipfile.ZipFile(out_file) as saved:
+        assert saved.testzip() is None
+        for i, p in enumerate(expected):
+            name = f'visio/pages/page{i + 1}.xml'
+            if i not in loaded_pages:
+                assert saved.read(name) == source.read(name)  # pages not loaded are saved unchanged
+    with VisioFile(out_file) as vis:
+        assert vis.pages[loaded_pages[0]].shapes[0].sub_shapes()[0].x == 1.25
+        assert [(p.name, ET.tostring(p.xml.getroot())) if i != loaded_pages[0] else None
+                for i, p in enumerate(vis.pages)] == expected
+
+
 @pytest.mark.parametrize("filename, page_name", [("test1.vsdx", "Page-1"), ("test2.vsdx", "Page-1")])
 def test_get_page(filename: str, page_name: str):
     with VisioFile(basedir+filename) as vis:
@@ -169,6 +391,134 @@ def test_get_shape_data_properties(filename: str, shape_name: str, property_dict
             assert prop.value == property_dict.get(prop.value)
 
 
+@pytest.mark.parametrize("filename", ["test_master.vsdx"])
+def test_property_table(filename: str):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_property_table.vsdx'
+
+    def add_property(shape_xml: ET.Element, name: str, cells: dict):
+        section = shape_xml.find(f'{namespace}Section[@N="Property"]')
+        if section is None:
+            section = ET.SubElement(shape_xml, f"{namespace}Section", {'N': 'Property'})
+        row = ET.SubElement(section, f"{namespace}Row", {'N': name})
+        for cell_name, value in cells.items():
+            ET.SubElement(row, f"{namespace}Cell", {'N': cell_name, 'V': value})
+
+    with VisioFile(basedir+filename) as vis:
+        shapes = vis.pages[0].shapes[0].sub_shapes()
+        master_shape = shapes[0].master_shape
+        add_property(master_shape.xml, 'Owner', {'Value': 'nobody', 'Label': 'Owner', 'Type': '0'})
+        add_property(master_shape.xml, 'Cost', {'Value': '10', 'Label': 'Cost', 'Type': '2'})
+        add_property(shapes[0].xml, 'Owner', {'Value': 'Alice'})  # overrides inherited value only
+        add_property(shapes[1].xml, 'Serial', {'Value': 'S1', 'Label': 'Serial No', 'Type': '0'})
+        instance_ids = [s.ID for s in vis.pages[0].shapes[0].sub_shapes() if s.master_page_ID == shapes[0].master_page_ID
+                        and s.master_shape_ID is None]
+        vis.save_vsdx(out_file)
+
+    with VisioFile(out_file) as vis:
+        table = vis.pages[0].property_table()
+        assert table['ID'] == [shapes[0].ID, shapes[1].ID] + [i for i in instance_ids if i != shapes[0].ID]
+        assert table['properties']['Owner'] == {'label': ['Owner', None] + ['Owner'] * (len(table['ID']) - 2),
+                                                'value': ['Alice', None] + ['nobody'] * (len(table['ID']) - 2),
+                                                'type': ['0', None] + ['0'] * (len(table['ID']) - 2)}
+        assert table['properties']['Serial']['value'] == [None, 'S1'] + [None] * (len(table['ID']) - 2)
+        assert table['properties']['Cost']['type'][0] == '2'
+
+        document_table = vis.property_table()
+        assert document_table['page'] == [vis.pages[0].name] * len(table['ID'])
+        assert document_table['ID'] == table['ID'] and document_table['properties'] == table['properties']
+
+
+@pytest.mark.parametrize("filename", ["test_master.vsdx"])
+def test_bind_properties(filename: str):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_bind_properties.vsdx'
+    with VisioFile(basedir+filename) as vis:
+        page = vis.pages[0]
+        shapes = page.shapes[0].sub_shapes()
+        # key property inherited from master by first shape, and set on second shape
+        master_section = ET.SubElement(shapes[0].master_shape.xml, f"{namespace}Section", {'N': 'Property'})
+        master_row = ET.SubElement(master_section, f"{namespace}Row", {'N': 'AssetTag'})
+        ET.SubElement(master_row, f"{namespace}Cell", {'N': 'Value', 'V': 'A1', 'U': 'STR'})
+        ET.SubElement(master_row, f"{namespace}Cell", {'N': 'Label', 'V': 'Asset Tag'})
+        page.bind_properties([{'AssetTag': 'A1'}], key='AssetTag')  # no values to set
+        VisioFile._set_property_value(shapes[1].xml, 'AssetTag', 'B2', inherited=False)
+
+        rows = [{'Prop.AssetTag': 'A1', 'Prop.Owner': 'Alice', 'Prop.IP': '10.0.0.1'},
+                {'Prop.AssetTag': 'B2', 'Prop.Owner': 'Bob'},
+                {'Prop.AssetTag': 'C3', 'Prop.Owner': 'Carol'},
+                {'Prop.Owner': 'Nobody'}]
+        assert page.bind_properties(rows, key='Prop.AssetTag') == ['C3', None]
+        vis.save_vsdx(out_file)
+
+    with VisioFile(out_file) as vis:
+        table = vis.pages[0].property_table()
+        values = {name: dict(zip(table['ID'], column['value'])) for name, column in table['properties'].items()}
+        assert values['AssetTag'][shapes[0].ID] == 'A1'  # still inherited
+        assert values['Owner'][shapes[0].ID] == 'Alice' and values['IP'][shapes[0].ID] == '10.0.0.1'
+        assert values['Owner'][shapes[1].ID] == 'Bob' and values['IP'][shapes[1].ID] is None
+        labels = dict(zip(table['ID'], table['properties']['AssetTag']['label']))
+        assert labels[shapes[0].ID] == 'Asset Tag'
+
+        # Property section is after cells in shape
+        shape_xml = vis.pages[0].find_shape_by_id(shapes[1].ID).xml
+        tags = [e.tag for e in shape_xml]
+        assert tags.index(f"{namespace}Section") > max(i for i, t in enumerate(tags) if t == f"{namespace}Cell")
+        # key property still only inherited by first shape
+        first_xml = vis.pages[0].find_shape_by_id(shapes[0].ID).xml
+        assert first_xml.find(f'{namespace}Section[@N="Property"]/{namespace}Row[@N="AssetTag"]') is None
+
+
+@pytest.mark.parametrize("filename, master_id, pages",
+                         [("test_master.vsdx", "2", None), ("test_master.vsdx", "8", None),
+                          ("test_master.vsdx", "2", []), ("test_master.vsdx", "8", [])])
+def test_add_shapes_from_master(filename: str, master_id: str, pages: list):
+    suffix = f'{master_id}_{"none" if pages is None else "selected"}'
+    in_file = basedir+'out'+ os.sep + filename[:-5] + f'_test_add_shapes_from_master_{suffix}_in.vsdx'
+    out_file = basedir+'out'+ os.sep + filename[:-5] + f'_test_add_shapes_from_master_{suffix}.vsdx'
+    rows = [{'x': i, 'y': 2 * i, 'text': f'Node {i}', 'cells': {'Width': 0.5}} for i in range(50)] + [{}]
+    # source file where first page is not yet related to the master
+    with VisioFile(basedir+filename) as vis:
+        master_filename = os.path.basename(vis.get_master_page_by_id(master_id).filename)
+    with zipfile.ZipFile(basedir+filename) as src, zipfile.ZipFile(in_file, 'w', zipfile.ZIP_DEFLATED) as dst:
+        for item in src.infolist():
+            data = src.read(item.filename)
+            if item.filename == 'visio/pages/_rels/page1.xml.rels':
+                rels = ET.fromstring(data)
+                for rel in list(rels):
+                    if rel.attrib['Target'] == f'../masters/{master_filename}':
+                        rels.remove(rel)
+                data = ET.tostring(rels)
+            dst.writestr(item, data)
+
+    with VisioFile(in_file, pages=pages) as vis:
+        shapes = vis.pages[0].add_shapes_from_master(master_id, rows)  # before page is loaded, if pages selected
+        max_id = max(int(e.attrib['ID']) for e in vis.pages[0].xml.getroot().iter(f"{namespace}Shape")
+                     if e not in [s.xml for s in shapes])
+        assert [s.ID for s in shapes] == [str(max_id + i + 1) for i in range(len(rows))]
+        new_page = vis.add_page('New Page')
+        new_page.add_shapes_from_master(master_id, rows[:2])
+        with pytest.raises(ValueError):
+            new_page.add_shapes_from_master('999', rows)
+        vis.save_vsdx(out_file)
+
+    with VisioFile(out_file) as vis:
+        master_text = vis.get_master_page_by_id(master_id).shapes[0].sub_shapes()[0].text
+        for page, count in zip(vis.pages, [len(rows), 2]):
+            shapes = [s for s in page.shapes[0].sub_shapes() if s.master_page_ID == master_id][-count:]
+            assert [(s.x, s.y, s.text) for s in shapes[:2]] == [(0, 0, 'Node 0'), (1, 2, 'Node 1')]
+            assert shapes[0].cell_value('Width') == '0.5'
+            ids = [e.attrib['ID'] for e in page.xml.getroot().iter(f"{namespace}Shape")]
+            assert len(ids) == len(set(ids))
+        assert vis.pages[0].shapes[0].sub_shapes()[-1].text == master_text  # text inherited from master
+        # relationship from each page to master added
+        targets = list()
+        for page in vis.pages:
+            rels = ET.parse(os.path.join(os.path.dirname(page.filename), '_rels',
+                                         os.path.basename(page.filename) + '.rels'))
+            targets.append([r.attrib['Target'] for r in rels.getroot()])
+        assert f'../masters/{master_filename}' in targets[0]
+        assert targets[1] == [f'../masters/{master_filename}']
+
+
 @pytest.mark.parametrize(("filename", "shape_names", "shape_x_y_deltas"),
                          [("test1.vsdx", {"Shape to remove"}, {(1.0, 1.0)}),
                           ("test4_connectors.vsdx", {"Shape B"}, {(1.0, 1.0)})])
@@ -350,6 +700,76 @@ def test_shape_copy(filename: str, shape_name: str):
         assert s.text == updated_text
 
 
+@pytest.mark.parametrize("filename", ["test1.vsdx", "test2.vsdx", "test4_connectors.vsdx"])
+def test_page_max_id(filename: str):
+    with VisioFile(basedir+filename) as vis:
+        page = vis.pages[0]  # type: VisioFile.Page
+        ids = [int(e.attrib['ID']) for e in page.xml.getroot().iter(f"{namespace}Shape")]
+        assert page.max_id == max(ids)
+        s = page.shapes[0].sub_shapes()[0]
+        for i in range(3):
+            new_shape = s.copy()
+            assert int(new_shape.ID) == max(ids) + i + 1
+        assert page.max_id == max(ids) + 3
+        ids = [int(e.attrib['ID']) for e in page.xml.getroot().iter(f"{namespace}Shape")]
+        assert len(ids) == len(set(ids))  # all shape IDs are unique
+        # max id found again when page xml replaced
+        page.xml = ET.ElementTree(ET.fromstring(ET.tostring(vis.pages[0].xml.getroot())))
+        assert page.max_id == max(ids)
+
+
+@pytest.mark.parametrize(("formula", "expected"),
+                         [("Sheet.5!Width*0.5", "Sheet.105!Width*0.5"),
+                          ("GUARD(Sheet.5!Width+Sheet.6!Height)", "GUARD(Sheet.105!Width+Sheet.106!Height)"),
+                          ("_XFTRIGGER(Sheet.7!EventXFMod)", "_XFTRIGGER(Sheet.7!EventXFMod)"),
+                          ("Sheet.55!PinX+Sheet.5!PinX", "Sheet.55!PinX+Sheet.105!PinX"),
+                          ("Width*0.5", "Width*0.5")])
+def test_update_ids(formula: str, expected: str):
+    shape = ET.fromstring(f"""<Shape xmlns="{namespace[1:-1]}" ID="5"><Cell N="PinX" F="{formula}"/>
+        <Section N="Geometry"><Row T="LineTo"><Cell N="X" F="{formula}"/></Row></Section>
+        <Shapes><Shape ID="6"><Cell N="PinY" F="{formula}"/></Shape></Shapes></Shape>""")
+    with VisioFile(basedir+'test1.vsdx') as vis:
+        vis.update_ids(shape, {'5': 105, '6': 106})
+    assert [c.attrib['F'] for c in shape.iter(f"{namespace}Cell")] == [expected] * 3
+
+
+@pytest.mark.parametrize(("filename", "shape_id", "offsets"),
+                         [("test2.vsdx", "9", (1, 0.5)),
+                          ("test2.vsdx", "7", None),
+                          ("test4_connectors.vsdx", "1", [(0, 1), (0, 2), (2, 0)])])
+def test_shape_copy_many(filename: str, shape_id: str, offsets):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + f'_test_shape_copy_many_{shape_id}.vsdx'
+    with VisioFile(basedir+filename) as vis:
+        page = vis.pages[0]  # type: VisioFile.Page
+        s = page.find_shape_by_id(shape_id)
+        max_id = page.max_id
+        n = 3
+        copies = s.copy_many(n, offsets=offsets)
+        assert len(copies) == n
+        size = len(list(s.xml.iter(f"{namespace}Shape")))
+        assert page.max_id == max_id + n * size
+        for i, c in enumerate(copies):
+            assert int(c.ID) == max_id + i * size + 1
+            assert c.text == s.text
+            if offsets is None:
+                assert (c.x, c.y) == (s.x, s.y)
+            else:
+                dx, dy = (offsets[0] * (i + 1), offsets[1] * (i + 1)) if isinstance(offsets, tuple) else offsets[i]
+                assert (c.x, c.y) == (s.x + dx, s.y + dy)
+            # copy formulas refer to the copy, not the original shape
+            formulas = [cell.attrib['F'] for cell in c.xml.iter(f"{namespace}Cell") if 'Sheet.' in cell.attrib.get('F', '')]
+            assert all(f"Sheet.{shape_id}!" not in f for f in formulas)
+            assert s.parent.xml.find(f".//{namespace}Shape[@ID='{c.ID}']") is not None
+        with pytest.raises(ValueError):
+            s.copy_many(2, offsets=[(0, 1)])
+        vis.save_vsdx(out_file)
+
+    with VisioFile(out_file) as vis:
+        ids = [int(e.attrib['ID']) for e in vis.pages[0].xml.getroot().iter(f"{namespace}Shape")]
+        assert len(ids) == len(set(ids))
+        assert vis.pages[0].find_shape_by_id(copies[-1].ID).text == s.text
+
+
 @pytest.mark.parametrize(("filename", "shape_name"),
                          [("test1.vsdx", "Shape to copy"),
                           ("test2.vsdx", "Shape to copy")])
@@ -544,6 +964,36 @@ def test_basic_jinja_loop(filename: str, context: dict):
                     assert page.find_shape_by_text(str(item))
 
 
+@pytest.mark.parametrize(("filename", "context"),
+                         [("test_jinja_loop.vsdx", {"date": datetime.now(), "scenario": "One", "test_list": [1, 2, 3]}),
+                          ("test_jinja_loop.vsdx", {"date": datetime.now(), "scenario": "Two", "test_list": [1]}),
+                          ])
+def test_jinja_loop_group_refs(filename: str, context: dict):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_jinja_loop_group_refs.vsdx'
+    with VisioFile(basedir+filename) as vis:
+        group = vis.pages[0].find_shape_by_id('9')  # loop group shape, with sub shapes 7 and 8
+        refs = [(group.xml, 'Sheet.7!Width+Sheet.8!Height'),
+                (group.find_shape_by_id('7').xml, 'Sheet.8!PinX*Sheet.8!PinY'),
+                (group.find_shape_by_id('8').xml, 'Sheet.9!Width+Sheet.6!Width')]  # 6 is outside group
+        for e, formula in refs:
+            ET.SubElement(e, f'{namespace}Cell', {'N': 'TxtWidth', 'V': '1', 'F': formula})
+        vis.jinja_render_vsdx(context=context)
+        vis.save_vsdx(out_file)
+
+    with VisioFile(out_file) as vis:
+        groups = [e for e in vis.pages[0].xml.getroot().iter(f'{namespace}Shape') if e.attrib.get('Type') == 'Group']
+        assert len(groups) == len(context['test_list'])
+        ids = [e.attrib['ID'] for e in vis.pages[0].xml.getroot().iter(f'{namespace}Shape')]
+        assert len(ids) == len(set(ids))
+        for g in groups:
+            # references in each copy are to the shapes in the same copy
+            s7, s8 = g.findall(f'{namespace}Shapes/{namespace}Shape')
+            formulas = [e.find(f'{namespace}Cell[@N="TxtWidth"]').attrib['F'] for e in (g, s7, s8)]
+            assert formulas == [f"Sheet.{s7.attrib['ID']}!Width+Sheet.{s8.attrib['ID']}!Height",
+                                f"Sheet.{s8.attrib['ID']}!PinX*Sheet.{s8.attrib['ID']}!PinY",
+                                f"Sheet.{g.attrib['ID']}!Width+Sheet.6!Width"]
+
+
 @pytest.mark.parametrize(("filename", "context"),
                          [("test_jinja_inner_loop.vsdx", {"test_list":[[1, 2, 3], [1, 2, 3], [1, 2, 3]]}),
                           ("test_jinja_inner_loop.vsdx", {"test_list":["One", "Two","Three"]}),
@@ -643,6 +1093,22 @@ def test_jinja_self_ref_calculations(filename: str, context: dict, shape_id, exp
         assert shape.text == expected_text
 
 
+@pytest.mark.parametrize(("filename", "context"), [("test_jinja_self_refs.vsdx", {"n": 2})])
+def test_jinja_expression_cache(filename: str, context: dict):
+    compile_jinja_expression.cache_clear()
+    with VisioFile(basedir+filename) as vis:
+        vis.jinja_render_vsdx(context=context)
+    first_render = compile_jinja_expression.cache_info()
+    assert first_render.misses
+
+    # each distinct expression is compiled once, so rendering again only hits the cache
+    with VisioFile(basedir+filename) as vis:
+        vis.jinja_render_vsdx(context=context)
+    second_render = compile_jinja_expression.cache_info()
+    assert second_render.misses == first_render.misses
+    assert second_render.hits == first_render.hits + first_render.misses
+
+
 @pytest.mark.parametrize(
     ("filename", "context", "expected_page_count", "expected_page_names"),
     [("test_jinja_page_showif.vsdx", {"show": True}, 2, ['Normal Page', 'Page2']),
@@ -672,6 +1138,310 @@ def test_jinja_page_showif(filename: str, context: dict, expected_page_count, ex
         assert page_names == expected_page_names
 
 
+@pytest.mark.parametrize(("filename", "static_page_files"),
+                         [("test1.vsdx", ['page2.xml', 'page3.xml']),
+                          ("test_jinja.vsdx", []),
+                          ])
+def test_jinja_static_pages_unchanged(filename: str, static_page_files: list):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_jinja_static_pages.vsdx'
+    with VisioFile(basedir+filename) as vis:
+        static_pages = [p for p in vis.pages if not p.contains_jinja()]
+        assert [os.path.basename(p.filename) for p in static_pages] == static_page_files
+        vis.jinja_render_vsdx(context={'date': datetime.now(), 'scenario': 'static', 'x': 1, 'y': 2})
+        # static pages are not parsed or rendered
+        assert all(p._xml is None for p in static_pages)
+        vis.save_vsdx(out_file)
+
+    # static pages are copied through to the new file unchanged
+    with zipfile.ZipFile(basedir+filename) as original, zipfile.ZipFile(out_file) as rendered:
+        for page_file in static_page_files:
+            assert rendered.read('visio/pages/'+page_file) == original.read('visio/pages/'+page_file)
+
+
+@pytest.mark.parametrize(("filename", "context"),
+                         [("test_jinja.vsdx", {"date": datetime.now(), "scenario": "Parallel", "x": 5, "y": 2}),
+                          ("test_jinja_page_showif.vsdx", {"show": False}),
+                          ("test_jinja_loop.vsdx", {"date": datetime.now(), "scenario": "Parallel", "test_list": [1, 2, 3]}),
+                          ])
+def test_jinja_render_parallel(filename: str, context: dict):
+    # render each page in a separate process and compare with pages rendered in turn
+    with VisioFile(basedir+filename) as vis:
+        vis.jinja_render_vsdx(context=context)
+        expected = [(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages]
+    with VisioFile(basedir+filename) as vis:
+        vis.jinja_render_vsdx(context=context, workers=2)
+        actual = [(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages]
+    assert actual == expected
+
+
+@pytest.mark.parametrize(("filename", "context"),
+                         [("test_jinja_loop.vsdx", {"date": datetime.now(), "scenario": "Compiled", "test_list": [1, 2, 3]}),
+                          ("test_jinja_self_refs.vsdx", {"n": 2}),
+                          ("test_jinja_page_showif.vsdx", {"show": False}),
+                          ])
+def test_jinja_compiled_template(filename: str, context: dict):
+    os.makedirs(basedir+'out', exist_ok=True)
+    compiled_file = basedir+'out'+ os.sep + filename[:-5] + '_compiled.vsdx'
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_jinja_compiled_template.vsdx'
+    VisioFile.compile_template(basedir+filename, compiled_file)
+
+    with VisioFile(basedir+filename) as vis:
+        vis.jinja_render_vsdx(context=context)
+        expected = [(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages]
+
+    # render from compiled template and check output matches
+    with VisioFile.load_compiled(compiled_file) as vis:
+        vis.jinja_render_vsdx(context=context)
+        actual = [(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages]
+        vis.save_vsdx(out_file)
+    assert actual == expected
+
+    # compiled template files are not included in rendered file
+    with zipfile.ZipFile(out_file) as rendered:
+        assert not [name for name in rendered.namelist() if name.startswith('vsdx_compiled')]
+
+
+@pytest.mark.parametrize(("filename", "page_name", "page_variables", "shape_variables"),
+                         [("test_jinja_loop.vsdx", "Page-1", {"date", "scenario", "test_list"},
+                           {"6": {"date", "scenario"}, "9": {"test_list"}, "7": {"test_list"}, "8": {"test_list"}}),
+                          ("test_jinja_self_refs.vsdx", "self refs", {"n"}, {"2": {"n"}, "3": {"n"}, "5": {"n"}}),
+                          ("test_jinja_page_showif.vsdx", "{% showif not show %}Page3", {"show"}, {"1": {"show"}}),
+                          ("test1.vsdx", "Page-2", set(), {}),
+                          ])
+def test_jinja_undeclared_variables(filename: str, page_name: str, page_variables: set, shape_variables: dict):
+    with VisioFile(basedir+filename) as vis:
+        page_xml = [ET.tostring(p.xml.getroot()) for p in vis.pages]
+        variables = vis.jinja_undeclared_variables()
+        assert variables[page_name]['page'] == page_variables
+        assert variables[page_name]['shapes'] == shape_variables
+        # pages are not changed by finding variables
+        assert [ET.tostring(p.xml.getroot()) for p in vis.pages] == page_xml
+
+
+@pytest.mark.parametrize(("filename", "contexts", "rendered_pages"),
+                         [("test_jinja.vsdx", [{"date": "today", "scenario": "One", "x": 2, "y": 2},
+                                               {"date": "today", "scenario": "Two", "x": 2, "y": 2},
+                                               {"date": "today", "scenario": "Two", "x": 20, "y": 2}],
+                           [['calc test', 'showif test'], ['calc test'], ['calc test', 'showif test']]),
+                          ("test_jinja_self_refs.vsdx", [{"n": 1}, {"n": 2}, {"n": 2}],
+                           [['self refs'], ['self refs'], []]),
+                          ("test_jinja_page_showif.vsdx", [{"show": True}, {"show": False}, {"show": True}],
+                           [['Normal Page', 'Page2'], ['Normal Page', 'Page3'], ['Normal Page', 'Page2']]),
+                          ("test_jinja_loop.vsdx", [{"date": "today", "scenario": "One", "test_list": [1, 2]},
+                                                    {"date": "today", "scenario": "One", "test_list": [1, 2, 3]}],
+                           [['Page-1'], ['Page-1']]),
+                          ])
+def test_jinja_renderer(filename: str, contexts: list, rendered_pages: list):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_jinja_renderer.vsdx'
+    template_file = basedir+'out'+ os.sep + filename[:-5] + '_test_jinja_renderer_template.vsdx'
+    os.makedirs(basedir+'out', exist_ok=True)
+    shutil.copy(basedir+filename, template_file)  # renderer keeps template open, while template file is rendered
+    with JinjaRenderer(VisioFile(template_file)) as renderer:
+        for context, page_names in zip(contexts, rendered_pages):
+            # only pages using changed values are rendered again
+            assert [p.name for p in renderer.render(context)] == page_names
+            renderer.save(out_file)
+
+            with VisioFile(out_file) as vis:
+                actual = [(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages]
+                # app.xml page titles kept in step with pages shown or hidden
+                i4 = vis.app_xml.getroot().find(f'{ext_prop_namespace}HeadingPairs').find(f'.//{vt_namespace}i4')
+                vector = vis.app_xml.getroot().find(f'{ext_prop_namespace}TitlesOfParts').find(f'{vt_namespace}vector')
+                assert [lpstr.text for lpstr in vector] == [p.name for p in vis.pages]
+                assert int(vector.attrib['size']) == int(i4.text) == len(vis.pages)
+            # check each update matches rendering template with full context
+            with VisioFile(basedir+filename) as vis:
+                vis.jinja_render_vsdx(context=context)
+                expected = [(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages]
+            assert actual == expected
+
+
+@pytest.mark.parametrize(("filename", "context"),
+                         [("test_jinja.vsdx", {"date": datetime.now(), "scenario": "Scenario One", "x": 2, "y": 2})])
+def test_jinja_render_cache(filename: str, context: dict):
+    cache_dir = basedir+'out'+ os.sep + 'test_jinja_render_cache'
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_jinja_render_cache.vsdx'
+    cache = RenderCache(cache_dir)
+    cache.clear()
+    for i in range(3):
+        assert cache.jinja_render_vsdx(basedir+filename, context, out_file + str(i)) == out_file + str(i) + '.vsdx'
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # cached copies match rendered file
+    with open(out_file + '0.vsdx', 'rb') as f0, open(out_file + '2.vsdx', 'rb') as f2:
+        assert f0.read() == f2.read()
+    with VisioFile(basedir+filename) as vis:
+        vis.jinja_render_vsdx(context=context)
+        expected = [ET.tostring(p.xml.getroot()) for p in vis.pages]
+    with VisioFile(out_file + '2.vsdx') as vis:
+        assert [ET.tostring(p.xml.getroot()) for p in vis.pages] == expected
+
+    # context with same values in different key order is a hit, changed value is a miss
+    cache.jinja_render_vsdx(basedir+filename, dict(reversed(list(context.items()))), out_file)
+    cache.jinja_render_vsdx(basedir+filename, {**context, "scenario": "other"}, out_file)
+    assert (cache.hits, cache.misses) == (3, 2)
+
+    # oldest entries removed when cache is full
+    cache.max_size = 1
+    cache.jinja_render_vsdx(basedir+filename, {**context, "scenario": "third"}, out_file)
+    assert len(os.listdir(cache_dir)) <= 1
+
+
+@pytest.mark.parametrize("filename", ["test_master.vsdx", "test5_master.vsdx"])
+def test_clone_masters(filename: str):
+    with VisioFile(basedir+filename) as template:
+        template.pages[0].shapes  # load page and the masters it uses
+        master_xml = [ET.tostring(m.xml.getroot()) for m in template.master_pages]
+        master_text = template.master_pages[0].shapes[0].sub_shapes()[0].text
+        with template.clone() as vis:
+            vis.master_pages[0].shapes[0].sub_shapes()[0].text = 'changed in clone'
+            assert vis.master_pages[0].shapes[0].sub_shapes()[0].text == 'changed in clone'
+        # template masters unchanged by changes to masters of a clone
+        assert template.master_pages[0].shapes[0].sub_shapes()[0].text == master_text
+        assert [ET.tostring(m.xml.getroot()) for m in template.master_pages] == master_xml
+
+
+@pytest.mark.parametrize(("filename", "contexts"),
+                         [("test_jinja.vsdx", [{"date": datetime.now(), "scenario": "One", "x": 0, "y": 2},
+                                               {"date": datetime.now(), "scenario": "Two", "x": 5, "y": 3}]),
+                          ("test_jinja_loop_showif.vsdx", [{"scenario": "One", "test_list": [1, 2, 3], "showif": True},
+                                                           {"scenario": "Two", "test_list": [], "showif": False}])])
+def test_jinja_clone(filename: str, contexts: list):
+    expected = list()
+    for context in contexts:
+        with VisioFile(basedir+filename) as vis:
+            vis.jinja_render_vsdx(context=context)
+            expected.append([(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages])
+
+    with VisioFile(basedir+filename) as template:
+        template_xml = [ET.tostring(p.xml.getroot()) for p in template.pages]
+        for i, context in enumerate(contexts):
+            out_file = basedir+'out'+ os.sep + filename[:-5] + f'_test_jinja_clone_{i}.vsdx'
+            vis = template.clone()
+            assert vis.directory != template.directory
+            vis.jinja_render_vsdx(context=context)
+            vis.save_vsdx(out_file)
+            assert not os.path.exists(vis.directory)
+
+            with VisioFile(out_file) as vis:
+                assert [(p.name, ET.tostring(p.xml.getroot())) for p in vis.pages] == expected[i]
+        # template unchanged by rendering clones
+        assert [ET.tostring(p.xml.getroot()) for p in template.pages] == template_xml
+
+        # restore template after it is rendered and saved
+        snapshot = template.snapshot()
+        template.jinja_render_vsdx(context=contexts[0])
+        template.save_vsdx(basedir+'out'+ os.sep + filename[:-5] + '_test_jinja_clone_saved.vsdx')
+        template.restore(snapshot)
+        assert [ET.tostring(p.xml.getroot()) for p in template.pages] == template_xml
+        snapshot.close_vsdx()
+
+
+@pytest.mark.parametrize(("filename", "context"),
+                         [("test_jinja.vsdx", {"date": datetime.now(), "scenario": "Scenario One", "x": 2, "y": 2})])
+@pytest.mark.parametrize("executor_type", [None, ThreadPoolExecutor, ProcessPoolExecutor])
+def test_jinja_async(filename: str, context: dict, executor_type):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_jinja_async.vsdx'
+    os.makedirs(basedir+'out', exist_ok=True)
+    with open(basedir+filename, 'rb') as f:
+        template = f.read()
+
+    async def render(source, target, config):
+        doc = await AsyncVisioFile.open(source, config=config)
+        assert (doc.vis is None) == (executor_type is ProcessPoolExecutor)
+        await doc.render(context)
+        return await doc.save(target)
+
+    async def render_all(config):
+        output = io.BytesIO()
+        results = await asyncio.gather(render(basedir+filename, out_file, config), render(template, None, config),
+                                       render(io.BytesIO(template), output, config))
+        return results, output.getvalue()
+
+    if executor_type is None:
+        (saved, contents, _), output = asyncio.run(render_all(None))
+    else:
+        with executor_type(max_workers=2) as executor:
+            config = AsyncConfig(executor=executor, max_concurrency=2)
+            (saved, contents, _), output = asyncio.run(render_all(config))
+    assert saved is None
+
+    with VisioFile(basedir+filename) as vis:
+        vis.jinja_render_vsdx(context=context)
+        expected = [ET.tostring(p.xml.getroot()) for p in vis.pages]
+    for source in [out_file, io.BytesIO(contents), io.BytesIO(output)]:
+        with VisioFile(source) as vis:
+            assert [ET.tostring(p.xml.getroot()) for p in vis.pages] == expected
+
+
+@pytest.mark.parametrize("filename", ["test1.vsdx", "test2.vsdx", "test4_connectors.vsdx", "test_master.vsdx"])
+def test_scan(filename: str):
+    out_file = basedir+'out'+ os.sep + filename[:-5] + '_test_scan.vsdx'
+    with VisioFile(basedir+filename) as vis:
+        # add data properties to first shape
+        shape = vis.pages[0].shapes[0].sub_shapes()[0]
+        section = shape.xml.find(f'{namespace}Section[@N="Property"]')
+        if section is None:
+            section = ET.SubElement(shape.xml, f"{namespace}Section", {'N': 'Property'})
+        row = ET.SubElement(section, f"{namespace}Row", {'N': 'AssetTag'})
+        ET.SubElement(row, f"{namespace}Cell", {'N': 'Value', 'V': 'A-100', 'U': 'STR'})
+        ET.SubElement(row, f"{namespace}Cell", {'N': 'Label', 'V': 'Asset Tag'})
+
+        expected = list()
+        for page in vis.pages:
+            def add_shapes(shape: VisioFile.Shape, parent_ID):
+                for s in shape.sub_shapes():
+                    text_element = s.xml.find(f"{namespace}Text")
+                    text = ''.join(text_element.itertext()) if text_element is not None else ''
+                    properties = [r.attrib['N'] for r in s.xml.findall(f'{namespace}Section[@N="Property"]/{namespace}Row')]
+                    expected.append((page.name, s.ID, parent_ID, s.master_page_ID, s.master_shape_ID, text,
+                                     {'PinX': s.cells['PinX'].value} if 'PinX' in s.cells else {}, properties))
+                    if s.shape_type == 'Group':
+                        add_shapes(s, s.ID)
+            for shapes in page.shapes:
+                add_shapes(shapes, None)
+        vis.save_vsdx(out_file)
+
+    records = list(vsdx.scan(out_file, cells=('PinX',)))
+    assert [(r.page, r.ID, r.parent_ID, r.master_page_ID, r.master_shape_ID, r.text, r.cells, list(r.properties))
+            for r in records] == expected
+    assert records[0].properties['AssetTag'] == {'Value': 'A-100', 'Label': 'Asset Tag'}
+
+
+@pytest.mark.parametrize("output_format, workers", [("jsonl", 2), ("csv", 1)])
+def test_extract_command(output_format: str, workers: int):
+    out_dir = basedir+'out'+ os.sep + f'test_extract_command_{output_format}'
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir + os.sep + 'files')
+    for filename in ["test1.vsdx", "test2.vsdx"]:
+        shutil.copy(basedir+filename, out_dir + os.sep + 'files')
+    with open(out_dir + os.sep + 'files' + os.sep + 'broken.vsdx', 'w') as f:
+        f.write('not a vsdx file')
+    out_file, progress_file = out_dir + os.sep + f'shapes.{output_format}', out_dir + os.sep + 'progress.txt'
+    args = ['extract', out_dir + os.sep + 'files', '--output', out_file, '--format', output_format,
+            '--workers', str(workers), '--progress', progress_file]
+
+    # first run stops after broken file, second run resumes
+    with open(progress_file, 'w') as f:
+        f.write(out_dir + os.sep + 'files' + os.sep + 'test2.vsdx\n')
+    assert vsdx_main.main(args) == 1  # error record for broken file
+    assert vsdx_main.main(args) == 0  # all files done
+
+    with open(out_file, newline='') as f:
+        if output_format == 'jsonl':
+            records = [json.loads(line) for line in f]
+        else:
+            records = list(csv.DictReader(f))
+    assert [r['file'] for r in records if r.get('error')] == [out_dir + os.sep + 'files' + os.sep + 'broken.vsdx']
+    shapes = [r for r in records if not r.get('error')]
+    expected = list(vsdx.scan(basedir+"test1.vsdx"))
+    assert [(r['page'], r['id'], r['text']) for r in shapes] == [(s.page, s.ID, s.text) for s in expected]
+    cells = shapes[0]['cells'] if output_format == 'jsonl' else {c: shapes[0][c] for c in expected[0].cells}
+    assert cells == expected[0].cells
+    properties = shapes[0]['properties'] if output_format == 'jsonl' else json.loads(shapes[0]['properties'])
+    assert properties == expected[0].properties
+
+
 @pytest.mark.parametrize(("filename", "shape_elements"), [("test1.vsdx", 4), ("test2.vsdx", 14), ("test3_house.vsdx", 10)])
 def test_xml_findall_shapes(filename: str, shape_elements: int):
     with VisioFile(basedir+filename) as vis:
@@ -983,6 +1753,57 @@ def test_copy_page_positions(filename: str, page_index_to_copy:int, page_positio
         assert index == out_page_index  # check that page location persists through file save and open
 
 
+@pytest.mark.parametrize(('filename', 'page_index_to_copy', 'page_position', 'names', 'out_page_names'),
+                         [
+                             ('test1.vsdx', 0, PagePosition.AFTER, ['A', 'B', 'A'], ['Page-1', 'A', 'B', 'A-1', 'Page-2']),
+                             ('test1.vsdx', 1, PagePosition.LAST, ['Page-1', 'Page-2'], ['Page-1', 'Page-2', 'Page-3', 'Page-1-1', 'Page-2-1']),
+                             ('test1.vsdx', 1, PagePosition.FIRST, [], ['Page-1', 'Page-2', 'Page-3']),
+                         ])
+def test_copy_page_many(filename: str, page_index_to_copy: int, page_position: PagePosition, names: list, out_page_names: list):
+    out_file = f'{basedir}out{os.sep}{filename[:-5]}_test_copy_page_many.vsdx'
+    with VisioFile(os.path.join(basedir, filename)) as vis:
+        page = vis.pages[page_index_to_copy]  # type: VisioFile.Page
+        new_pages = vis.copy_page_many(page, names, index=page_position)
+        assert len(new_pages) == len(names)
+        assert [p.name for p in vis.pages][:len(out_page_names)] == out_page_names
+        for new_page in new_pages:
+            assert [s.ID for s in new_page.find_shapes_by_text('')] == [s.ID for s in page.find_shapes_by_text('')]
+        vis.save_vsdx(out_file)
+
+    with VisioFile(out_file) as vis:
+        assert [p.name for p in vis.pages][:len(out_page_names)] == out_page_names
+        assert len(vis.pages) == 3 + len(names)
+        assert len(set(p.filename for p in vis.pages)) == len(vis.pages)
+        TitlesOfParts = vis.app_xml.getroot().find(f'{ext_prop_namespace}TitlesOfParts')
+        vector = TitlesOfParts.find(f'{vt_namespace}vector')
+        assert int(vector.attrib['size']) == len(vector) == len(vis.pages)
+
+
+@pytest.mark.parametrize("filename", ["test1.vsdx"])
+def test_page_set_name(filename: str):
+    out_file = f'{basedir}out{os.sep}{filename[:-5]}_test_page_set_name.vsdx'
+    with VisioFile(os.path.join(basedir, filename)) as vis:
+        new_page = vis.add_page('Added')  # in memory change to pages.xml, kept when pages renamed
+        vis.pages[1].set_name('Renamed')
+        vis.pages[2].set_name('Page-1')  # duplicate name, first page is still found by name
+        assert vis.get_page_by_name('Renamed') is vis.pages[1]
+        assert vis.get_page_by_name('Page-2') is None
+        assert vis.get_page_by_name('Page-1') is vis.pages[0]
+        vis.pages[0].set_name('First')
+        assert vis.get_page_by_name('Page-1') is vis.pages[2]
+        assert vis.get_page_by_name('First') is vis.pages[0]
+        assert vis.get_page_by_name('Added') is new_page
+        assert [p.index_num for p in vis.pages] == list(range(len(vis.pages)))
+        vis.remove_page_by_index(0)
+        assert vis.get_page_by_name('First') is None
+        assert new_page.index_num == 2
+        names = [p.name for p in vis.pages]
+        vis.save_vsdx(out_file)
+
+    with VisioFile(out_file) as vis:
+        assert [p.name for p in vis.pages] == names
+
+
 @pytest.mark.parametrize(("filename"),
                          [("test1.vsdx"),
                           ])
@@ -1,11 +1,26 @@
 from __future__ import annotations
 import zipfile
+import sys
 import shutil
 import os
+import posixpath
 import re
+import json
+import copy
+import hashlib
+import struct
+import zlib
+import io
+import tempfile
+import weakref
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
 from enum import IntEnum
-from jinja2 import Template
-from typing import Optional, List
+from functools import lru_cache, partial
+from itertools import repeat
+from jinja2 import Environment, DictLoader, BytecodeCache, meta
+from typing import Optional, List, Dict, Set, Iterator, Iterable
 
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import Element
@@ -16,6 +31,23 @@ namespace = "{http://schemas.microsoft.com/office/visio/2012/main}"  # visio fil
 ext_prop_namespace = '{http://schemas.openxmlformats.org/officeDocument/2006/extended-properties}'
 vt_namespace = '{http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes}'
 
+jinja_markers = ('{{', '{%', '{#')  # start of any Jinja expression, statement or comment
+jinja_env = Environment()  # shared by all templates and expressions, so compiled expressions can be cached
+compiled_template_dir = 'vsdx_compiled'  # directory in compiled template file containing preprocessed pages
+raw_zip_versions = ((3, 7), (3, 13))  # Python versions where vsdx files are saved using private zipfile internals
+compressed_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.emz', '.wmz', '.wdp', '.zip'}  # stored, not deflated
+
+# compiled regular expressions for vsdx specific Jinja statements
+_set_self_re = re.compile(r'{% set self.(.*?)\s?=\s?(.*?) %}')  # expect ('property', 'value') such as ('x', '10')
+_set_self_statement_re = re.compile(r'{% set self.*?%}')
+_self_ref_re = re.compile(r'\bself\.')  # self is reserved in Jinja, so self refs are renamed before evaluation
+_statement_re = re.compile(r'{%(.*?)%}')
+_for_loop_re = re.compile(r'{% for\s(.*?)\s%}')
+_showif_re = re.compile(r'{% showif\s(.*?)\s%}')
+_master_ref_re = re.compile(rb'\sMaster="(.*?)"')
+_sheet_ref_re = re.compile(r'\bSheet\.(\d+)!')  # reference to a cell in another shape, such as Sheet.5!Width
+_declaration_re = re.compile(r'{%-?\s*(set|macro|import|from|include|call)\s')  # statements that can affect other shapes
+
 
 # utility functions
 def to_float(val: str):
@@ -27,6 +59,47 @@ def to_float(val: str):
         return 0.0
 
 
+def render_jinja_source(source: str, context: dict) -> bytes:
+    """Render a preprocessed page source with context, returning the rendered xml as utf-8 bytes
+
+    Defined at module level so that pages can be rendered in a separate process
+    """
+    return jinja_env.from_string(source).render(context).encode('utf-8')
+
+
+@lru_cache(maxsize=1024)
+def compile_jinja_expression(expression: str):
+    """Compile a Jinja expression such as 'n * 2' once, returning a callable taking the context
+
+    Compiled expressions are cached by expression text, so repeated expressions are compiled only once
+    """
+    return jinja_env.compile_expression(expression, undefined_to_none=False)
+
+
+@lru_cache(maxsize=1024)
+def jinja_expression_variables(expression: str) -> frozenset:
+    """Return the names of variables used in a Jinja expression such as 'n * 2', that must be provided by context"""
+    return frozenset(meta.find_undeclared_variables(jinja_env.parse('{{ ' + expression + ' }}')))
+
+
+class _DictBytecodeCache(BytecodeCache):
+    # Jinja bytecode cache held in a dict of key: bytecode, to store in and load from a compiled template file
+    def __init__(self, mapping: dict):
+        self.mapping = mapping
+
+    def load_bytecode(self, bucket):
+        code = self.mapping.get(bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        self.mapping[bucket.key] = bucket.bytecode_to_string()
+
+
+class ReadOnlyError(Exception):
+    """Raised when a VisioFile frozen by :meth:`VisioFile.freeze` would be changed"""
+
+
 class PagePosition(IntEnum):
     FIRST =  0
     LAST  = -1
@@ -47,26 +120,40 @@ class VisioFile:
 
     Contains :class:`Page`, :class:`Shape`, :class:`Connect` and :class:`Cell` sub-classes
     """
-    def __init__(self, filename, debug: bool = False):
+    def __init__(self, filename, debug: bool = False, pages: Optional[list] = None):
         """VisioFile constructor
 
         :param filename: the vsdx file to load and create the VisioFile object from
-        :type filename: str
+        :type filename: str, or binary file object
         :param debug: enable/disable debugging
         :type debug: bool, default to False
+        :param pages: names or zero-based indexes of pages to load, with the master pages they use. Other pages are
+            only read from the vsdx file if used, and are saved unchanged otherwise
+        :type pages: list of str or int, optional - default of None extracts all pages
         """
         self.debug = debug
         self.filename = filename
         if debug:
             print(f"VisioFile(filename={filename})")
-        self.directory = f"./{filename.rsplit('.', 1)[0]}"
+        # private temporary directory, so the same file can be opened by many VisioFile objects at the same time
+        self.directory = tempfile.mkdtemp(prefix=f"{_file_stem(filename)}_")
         self.pages_xml = None
         self.pages_xml_rels = None
         self.content_types_xml = None
         self.app_xml = None
         self.pages = list()  # type: List[VisioFile.Page]  # list of Page objects, populated by open_vsdx_file()
         self.master_pages = list()  # type: List[VisioFile.Page]  # list of Page objects, populated by open_vsdx_file()
-        self.open_vsdx_file()
+        self.read_only = False  # set by freeze()
+        self._master_index = None  # master page ID: Page, built by freeze()
+        self._page_names = None  # page name: first Page with that name, built when first needed
+        self._page_positions = None  # Page: index in pages, built when first needed
+        self._passthrough_parts = set()  # names of parts left in vsdx file, populated by open_vsdx_file()
+        self._page_selection = pages
+        try:
+            self.open_vsdx_file()
+        except BaseException:
+            self.close_vsdx()  # remove private directory, which would otherwise be left behind
+            raise
 
     def __enter__(self):
         return self
@@ -82,13 +169,41 @@ class VisioFile:
             return f"Not an Element. type={type(xml)}"
 
     def open_vsdx_file(self):
+        extract_all = not isinstance(self.filename, (str, os.PathLike))  # a file object may be closed before saving
         with zipfile.ZipFile(self.filename, "r") as zip_ref:
-            zip_ref.extractall(self.directory)
+            for info in zip_ref.infolist():
+                if extract_all or (_is_parsed_part(info.filename) and
+                                   not (self._page_selection is not None and _is_page_part(info.filename))):
+                    zip_ref.extract(info, self.directory)
+                elif not info.is_dir():
+                    # binary parts such as media, and pages not selected, are left in the vsdx file until used
+                    self._passthrough_parts.add(info.filename)
 
         # load each page file into an ElementTree object
         self.load_pages()
         self.load_master_pages()
 
+        if self._page_selection is not None:
+            # load selected pages, and master pages they use
+            for item in self._page_selection:
+                page = self.get_page(item) if isinstance(item, int) else self.get_page_by_name(item)
+                if page:
+                    for master_id in set(e.attrib['Master'] for e in page.xml.getroot().iter() if 'Master' in e.attrib):
+                        master_page = self.get_master_page_by_id(master_id)
+                        if master_page:
+                            master_page.xml
+
+    def _extract_part(self, filename: str):
+        # extract part, and its relationships part, if left in the vsdx file when opened
+        part_name = self._part_name(filename)
+        rels_part_name = posixpath.join(posixpath.dirname(part_name), '_rels', posixpath.basename(part_name) + '.rels')
+        part_names = [name for name in (part_name, rels_part_name) if name in self._passthrough_parts]
+        if part_names:
+            with zipfile.ZipFile(self.filename, "r") as zip_ref:
+                for name in part_names:
+                    zip_ref.extract(name, self.directory)
+                    self._passthrough_parts.discard(name)
+
     def _pages_filename(self):
         page_dir = f'{self.directory}/visio/pages/'
         pages_filename = page_dir + 'pages.xml'  # pages.xml contains Page name, width, height, mapped to Id
@@ -122,7 +237,7 @@ class VisioFile:
 
             page_path = page_dir + relid_page_dict.get(rel_id, None)
 
-            new_page = VisioFile.Page(file_to_xml(page_path), page_path, page_name, self)
+            new_page = VisioFile.Page(None, page_path, page_name, self)  # page xml is loaded when first used
             self.pages.append(new_page)
 
             if self.debug:
@@ -163,7 +278,7 @@ class VisioFile:
 
             master_path = relid_to_path[rel_id]
 
-            master_page = VisioFile.Page(file_to_xml(master_path), master_path, master_id, self)
+            master_page = VisioFile.Page(None, master_path, master_id, self)  # master xml is loaded when first used
             self.master_pages.append(master_page)
 
             if self.debug:
@@ -188,10 +303,31 @@ class VisioFile:
 
                 :return: :class:`Page` object representing the page (or None if not found)
                 """
-        for p in self.pages:
+        page_names, page_positions = self._page_indexes()
+        page = page_names.get(name)
+        index = page_positions.get(page, -1)
+        if page is not None and page.name == name and 0 <= index < len(self.pages) and self.pages[index] is page:
+            return page
+        for p in self.pages:  # name not indexed, e.g. name of a page with a duplicate name was changed
             if p.name == name:
+                page_names[name] = p
                 return p
 
+    def _page_indexes(self) -> (Dict[str, VisioFile.Page], Dict[VisioFile.Page, int]):
+        # return dicts of page name: Page and Page: index, built once and then reused until pages are added or removed
+        if self._page_positions is None:
+            page_names = dict()
+            for p in self.pages:
+                page_names.setdefault(p.name, p)
+            self._page_names = page_names
+            self._page_positions = {p: i for i, p in enumerate(self.pages)}
+        return self._page_names, self._page_positions
+
+    def _pages_changed(self):
+        # pages added, removed or reordered, so page indexes are rebuilt when next needed
+        self._page_names = None
+        self._page_positions = None
+
     def get_master_page_by_id(self, id: str):
         """Get master page from VisioFile with matching ID.
 
@@ -202,6 +338,8 @@ class VisioFile:
 
                 :return: :class:`Page` object representing the master page (or None if not found)
                 """
+        if self._master_index is not None:
+            return self._master_index.get(id)
         for m in self.master_pages:
             if m.name == id:
                 return m
@@ -214,6 +352,7 @@ class VisioFile:
 
         :return: None
         """
+        self._check_writable()
 
         # remove Page element from pages.xml file - zero based index
         # todo:  similar function by page id, and by page title
@@ -223,6 +362,7 @@ class VisioFile:
             page = self.pages[index]  # type: VisioFile.Page
             self._remove_page_from_app_xml(page.name)
             del self.pages[index]
+            self._pages_changed()
 
     def _update_pages_xml_rels(self, new_page_filename: str) -> str:
         '''Updates the pages.xml.rels file with a reference to the new page and returns the new relid
@@ -241,9 +381,11 @@ class VisioFile:
 
         return new_page_relid
 
-    def _get_new_page_name(self, new_page_name: str) -> str:
+    def _get_new_page_name(self, new_page_name: str, page_names: Optional[Set[str]] = None) -> str:
+        if page_names is None:
+            page_names = set(self.get_page_names())
         i = 1
-        while new_page_name in self.get_page_names():
+        while new_page_name in page_names:
             new_page_name = f'{new_page_name}-{i}'  # Page-X-i
             i += 1
 
@@ -294,7 +436,7 @@ class VisioFile:
         # then add it:
         content_types.insert(idx+1, content_types_element)
 
-    def _add_page_to_app_xml(self, new_page_name: str):
+    def _add_page_to_app_xml(self, new_page_name: str, index: Optional[int] = None):
         HeadingPairs = self.app_xml.getroot().find(f'{ext_prop_namespace}HeadingPairs')
         i4 = HeadingPairs.find(f'.//{vt_namespace}i4')
         num_pages = int(i4.text)
@@ -305,10 +447,21 @@ class VisioFile:
 
         lpstr = Element(f'{vt_namespace}lpstr')
         lpstr.text = new_page_name
-        vector.append(lpstr)  # add new lpstr element with new page name
+        if index is None:
+            vector.append(lpstr)  # add new lpstr element with new page name
+        else:
+            vector.insert(index, lpstr)
         vector_size = int(vector.attrib['size'])
         vector.set('size', str(vector_size+1))  # increment as page added
 
+    def _rename_page_in_app_xml(self, page_name: str, new_page_name: str):
+        TitlesOfParts = self.app_xml.getroot().find(f'{ext_prop_namespace}TitlesOfParts')
+        vector = TitlesOfParts.find(f'{vt_namespace}vector')
+        for lpstr in vector.findall(f'{vt_namespace}lpstr'):
+            if lpstr.text == page_name:
+                lpstr.text = new_page_name
+                break
+
     def _remove_page_from_app_xml(self, page_name: str):
         HeadingPairs = self.app_xml.getroot().find(f'{ext_prop_namespace}HeadingPairs')
         i4 = HeadingPairs.find(f'.//{vt_namespace}i4')
@@ -366,6 +519,7 @@ class VisioFile:
         new_page = VisioFile.Page(new_page_xml, new_page_path, page_name, self)
 
         self.pages.insert(index, new_page)  # insert new page at defined index
+        self._pages_changed()
 
         return new_page
 
@@ -380,6 +534,7 @@ class VisioFile:
 
         :return: :class:`Page` object representing the new page
         """
+        self._check_writable()
 
         # Determine the new page's name
         new_page_name = self._get_new_page_name(name or f'Page-{len(self.pages) + 1}')
@@ -463,6 +618,7 @@ class VisioFile:
 
         :return: the newly created page
         """
+        self._check_writable()
         # Determine the new page's name
         new_page_name = self._get_new_page_name(name or page.name)
 
@@ -502,6 +658,105 @@ class VisioFile:
 
         return new_page
 
+    def copy_page_many(self, page: VisioFile.Page, names: Iterable[str], *,
+                       index: Optional[int] = PagePosition.AFTER) -> List[VisioFile.Page]:
+        """Add a copy of an existing page for each name, as consecutive pages
+
+        Equivalent to calling :meth:`copy_page` for each name, but pages.xml, pages.xml.rels, [Content_Types].xml
+        and app.xml are updated once for all the copies, which is much faster when making many copies
+
+        :param page: the :class Page: to copy
+        :type page: VisioFile.Page
+        :param names: names of the new pages (note these may be altered if a name already exists)
+        :type names: iterable of str
+        :param index: the specific int or relation PagePosition location for the first new page
+        :type index: int or PagePosition
+
+        :return: list of the newly created pages
+        """
+        self._check_writable()
+        page_dir = f'{self.directory}/visio/pages/'
+        rels_namespace = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+        page_root = page.xml.getroot()  # load page, and its rels file, before copying
+        page_element = self.pages_xml.getroot().findall(f"{namespace}Page")[page.index_num]
+        page_rels_file = f'{page_dir}_rels/{os.path.basename(page.filename)}.rels'
+        if not os.path.exists(page_rels_file):
+            page_rels_file = None
+
+        # counters for new page names, filenames, page IDs and rel IDs, found once for all the copies
+        page_names = set(self.get_page_names())
+        page_filenames = set(os.path.basename(p.filename) for p in self.pages)
+        file_num = len(self.pages)
+        page_id = self._get_max_page_id()
+        relid = max((int(rel.attrib['Id'][3:]) for rel in self.pages_xml_rels.getroot()), default=0)  # 'rIdXX' -> XX
+
+        new_pages = list()
+        new_page_elements = list()
+        new_rels = list()
+        for name in names:
+            new_page_name = self._get_new_page_name(name, page_names)
+            page_names.add(new_page_name)
+            file_num += 1
+            while f'page{file_num}.xml' in page_filenames:
+                file_num += 1
+            new_page_filename = f'page{file_num}.xml'
+            page_id += 1
+            relid += 1
+
+            new_rels.append(Element(f'{rels_namespace}Relationship', {
+                'Target': new_page_filename,
+                'Type': 'http://schemas.microsoft.com/visio/2010/relationships/page',
+                'Id': f'rId{relid}'
+            }))
+            new_page_element = copy.deepcopy(page_element)
+            new_page_element.attrib['ID'] = str(page_id)
+            new_page_element.attrib['NameU'] = new_page_name
+            new_page_element.attrib['Name'] = new_page_name
+            new_page_element.find(f'{namespace}Rel').attrib['{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'] = f'rId{relid}'
+            new_page_elements.append(new_page_element)
+
+            new_page = VisioFile.Page(ET.ElementTree(copy.deepcopy(page_root)), page_dir + new_page_filename,
+                                      new_page_name, self)
+            new_page._max_id = page._max_id
+            new_pages.append(new_page)
+            if page_rels_file:
+                shutil.copy(page_rels_file, f'{page_dir}_rels/{new_page_filename}.rels')
+
+        if not new_pages:
+            return new_pages
+
+        # update pages.xml.rels, pages.xml, [Content_Types].xml and app.xml once for all new pages
+        self.pages_xml_rels.getroot().extend(new_rels)
+        index = self._get_index(index=index, page=page)
+        self.pages_xml.getroot()[index:index] = new_page_elements
+        self.pages[index:index] = new_pages
+        self._pages_changed()
+
+        cont_types_namespace = '{http://schemas.openxmlformats.org/package/2006/content-types}'
+        content_types = self.content_types_xml.getroot()
+        all_page_overrides = content_types.findall(
+            f'{cont_types_namespace}Override[@ContentType="application/vnd.ms-visio.page+xml"]'
+        )
+        idx = list(content_types).index(all_page_overrides[-1])
+        content_types[idx+1:idx+1] = [
+            Element(f'{cont_types_namespace}Override', {'PartName': f'/visio/pages/{os.path.basename(p.filename)}',
+                                                        'ContentType': 'application/vnd.ms-visio.page+xml'})
+            for p in new_pages]
+
+        if self.app_xml:
+            HeadingPairs = self.app_xml.getroot().find(f'{ext_prop_namespace}HeadingPairs')
+            i4 = HeadingPairs.find(f'.//{vt_namespace}i4')
+            i4.text = str(int(i4.text) + len(new_pages))
+            TitlesOfParts = self.app_xml.getroot().find(f'{ext_prop_namespace}TitlesOfParts')
+            vector = TitlesOfParts.find(f'{vt_namespace}vector')
+            for p in new_pages:
+                lpstr = Element(f'{vt_namespace}lpstr')
+                lpstr.text = p.name
+                vector.append(lpstr)
+            vector.set('size', str(int(vector.attrib['size']) + len(new_pages)))
+
+        return new_pages
+
     # TODO: dead code - never used
     def get_sub_shapes(self, shape: Element, nth=1):
         for e in shape:
@@ -567,51 +822,294 @@ class VisioFile:
         for shape in shapes.findall(f"{namespace}Shape"):
             _replace_shape_text(shape, context)
 
-    def jinja_render_vsdx(self, context: dict):
+    def property_table(self) -> dict:
+        """Get the data properties of every shape in every page as columns, see :meth:`Page.property_table`
+
+        :return: dict with 'page' list of page names, 'ID' list of shape IDs, and 'properties' dict of property
+            name: dict of 'label', 'value' and 'type' lists
+        """
+        table = {'page': list(), 'ID': list(), 'properties': dict()}
+        master_properties = dict()  # shared by pages, so each master shape is read once
+        for page in self.pages:  # type: VisioFile.Page
+            for shape_id, properties in page._property_rows(master_properties):
+                table['page'].append(page.name)
+                VisioFile._add_property_row(table, shape_id, properties)
+        return table
+
+    def _master_properties(self, master_page_ID: str, master_shape_ID: Optional[str], cache: dict) -> dict:
+        key = (master_page_ID, master_shape_ID)
+        if key not in cache:
+            properties = dict()
+            master_page = self.get_master_page_by_id(master_page_ID)
+            master_shape = master_page.xml.getroot().find(f"{namespace}Shapes/{namespace}Shape") if master_page else None
+            if master_shape is not None and master_shape_ID is not None:
+                # sub shape of the master shape
+                master_shape = next((e for e in master_shape.iter(f"{namespace}Shape")
+                                     if e.attrib.get('ID') == master_shape_ID), None)
+            if master_shape is not None:
+                VisioFile._update_properties(properties, master_shape)
+            cache[key] = properties
+        return cache[key]
+
+    @staticmethod
+    def _update_properties(properties: dict, shape: Element):
+        # update {property name: {cell name: value}} with Property rows of shape, which override inherited cells
+        for row in shape.findall(f'{namespace}Section[@N="Property"]/{namespace}Row'):
+            name = row.attrib.get('N')
+            if row.attrib.get('Del') == '1':
+                properties.pop(name, None)  # inherited property deleted
+                continue
+            cells = dict(properties.get(name, {}))
+            cells.update((cell.attrib.get('N'), cell.attrib.get('V')) for cell in row.findall(f"{namespace}Cell"))
+            properties[name] = cells
+
+    @staticmethod
+    def _set_property_value(shape: Element, name: str, value: str, inherited: bool):
+        # set Value cell of Property row in shape, creating section, row and cell if needed
+        section = shape.find(f'{namespace}Section[@N="Property"]')
+        if section is None:
+            section = Element(f"{namespace}Section", {'N': 'Property'})
+            # Cell and Trigger elements are before Section elements in a Shape
+            index = next((i for i, e in enumerate(shape) if e.tag not in (f"{namespace}Cell", f"{namespace}Trigger")),
+                         len(shape))
+            shape.insert(index, section)
+        row = section.find(f'{namespace}Row[@N="{name}"]')
+        if row is None:
+            row = ET.SubElement(section, f"{namespace}Row", {'N': name})
+            if not inherited:
+                ET.SubElement(row, f"{namespace}Cell", {'N': 'Label', 'V': name})
+                ET.SubElement(row, f"{namespace}Cell", {'N': 'Type', 'V': '0'})
+        cell = row.find(f'{namespace}Cell[@N="Value"]')
+        if cell is None:
+            cell = Element(f"{namespace}Cell", {'N': 'Value', 'U': 'STR'})
+            row.insert(0, cell)
+        cell.attrib['V'] = value
+        cell.attrib.pop('F', None)  # value replaces any formula
+
+    @staticmethod
+    def _add_property_row(table: dict, shape_id: str, properties: dict):
+        rows = len(table['ID'])
+        table['ID'].append(shape_id)
+        for name in properties:
+            if name not in table['properties']:
+                table['properties'][name] = {'label': [None] * rows, 'value': [None] * rows, 'type': [None] * rows}
+        for name, column in table['properties'].items():
+            cells = properties.get(name, {})
+            column['label'].append(cells.get('Label'))
+            column['value'].append(cells.get('Value'))
+            column['type'].append(cells.get('Type'))
+
+    def jinja_render_vsdx(self, context: dict, workers: Optional[int] = None):
         """Transform a template VisioFile object using the Jinja language
         The method updates the VisioFile object loaded from the template file, so does not return any value
         Note: vsdx specific extensions are available such as `{% for item in list %}` statements with no `{% endfor %}`
 
         :param context: A dictionary containing values that can be accessed by the Jinja processor
         :type context: dict
+        :param workers: number of processes used to render pages concurrently (context must be picklable)
+        :type workers: int, optional - default of None renders each page in turn
 
         :return: None
         """
+        self._check_writable()
         # parse each shape in each page as Jinja2 template with context
         pages_to_remove = []  # list of pages to be removed after loop
+        pages_to_render = []  # list of (page, source, template, loop_shape_ids, set_selfs) tuples, rendered after loop
         for page in self.pages:  # type: VisioFile.Page
             # check if page should be removed
             if VisioFile.jinja_page_showif(page, context):
-                loop_shape_ids = list()
-                for shapes_by_id in page.shapes:  # type: VisioFile.Shape
-                    VisioFile.jinja_render_shape(shape=shapes_by_id, context=context, loop_shape_ids=loop_shape_ids)
-
-                source = ET.tostring(page.xml.getroot(), encoding='unicode')
-                source = VisioFile.unescape_jinja_statements(source)  # unescape chars like < and > inside {%...%}
-                template = Template(source)
-                output = template.render(context)
-                page.xml = ET.ElementTree(ET.fromstring(output))  # create ElementTree from Element created from output
-
-                # update loop shape IDs
-                page.set_max_ids()
-                for shape_id in loop_shape_ids:
-                    shapes_by_id = page.find_shapes_by_id(shape_id)  # type: List[VisioFile.Shape]
-                    if shapes_by_id and len(shapes_by_id) > 1:
-                        delta = 0
-                        for shape in shapes_by_id[1:]:  # from the 2nd onwards - leaving original unchanged
-                            # increment each new shape duplicated by the jinja loop
-                            self.increment_sub_shape_ids(shape, page)
-                            delta += shape.height  # automatically move each duplicate down
-                            shape.move(0, -delta)  # move duplicated shapes so they are visible
+                if page._jinja_compiled:
+                    # page was preprocessed and compiled by compile_template()
+                    pages_to_render.append((page, *page._jinja_compiled))
+                    page._jinja_compiled = None
+                elif page.contains_jinja():
+                    source, loop_shape_ids, set_selfs = self._jinja_prepare_page(page)
+                    pages_to_render.append((page, source, None, loop_shape_ids, set_selfs))
+                # else static page - leave untouched, so it is copied through unchanged when saved
             else:
                 # note page to remove after this loop has completed
                 pages_to_remove.append(page)
+
+        # render page sources - each page is independent so may be rendered in parallel processes
+        sources = [source for _, source, _, _, _ in pages_to_render]
+        if workers and workers > 1 and len(sources) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(sources))) as executor:
+                outputs = list(executor.map(render_jinja_source, sources, repeat(context)))
+        else:
+            outputs = [template.render(context).encode('utf-8') if template else render_jinja_source(source, context)
+                       for _, source, template, _, _ in pages_to_render]
+
+        for (page, _, _, loop_shape_ids, set_selfs), output in zip(pages_to_render, outputs):
+            self._jinja_finish_page(page, output, loop_shape_ids, set_selfs, context)
+
         # remove pages after processing
         for p in pages_to_remove:
             self.remove_page_by_index(p.index_num)
 
+    def jinja_undeclared_variables(self) -> Dict[str, dict]:
+        """Find the context variables used by each page and shape, without rendering or changing the VisioFile
+
+        Pages are preprocessed in the same way as :meth:`jinja_render_vsdx`, so a context can be validated
+        against the result before rendering
+
+        :return: dict of page name: {'page': set of variable names, 'shapes': dict of shape ID: set of variable names}
+        """
+        variables = dict()
+        for page in self.pages:  # type: VisioFile.Page
+            page_variables = set()
+            shape_variables = dict()
+            show_ifs = _showif_re.findall(page.name)
+            if show_ifs:
+                page_variables.update(jinja_expression_variables(show_ifs[-1]))
+            if page.contains_jinja():
+                for shapes in page.shapes:  # type: VisioFile.Shape
+                    VisioFile._jinja_shape_variables(shapes, [], shape_variables)
+
+                # preprocess a copy of the page, so that the page itself is unchanged
+                page_copy = VisioFile.Page(ET.ElementTree(copy.deepcopy(page.xml.getroot())), page.filename, page.name, self)
+                source, _, set_selfs = self._jinja_prepare_page(page_copy)
+                page_variables.update(meta.find_undeclared_variables(jinja_env.parse(source)))
+                for _, _, value in set_selfs:
+                    page_variables.update(jinja_expression_variables(_self_ref_re.sub('vsdx_self.', value)))
+                page_variables.discard('vsdx_self')
+            variables[page.name] = {'page': page_variables, 'shapes': shape_variables}
+        return variables
+
+    @staticmethod
+    def _jinja_shape_variables(shape: VisioFile.Shape, statements: list, shape_variables: dict):
+        # record variables used by each sub shape, within any loops and showifs of the shapes containing it
+        for s in shape.sub_shapes():  # type: VisioFile.Shape
+            if s.tag != f"{namespace}Shape":
+                continue  # sub_shapes() of a non-group shape are its Cell, Section and Text elements
+            text = s.text
+            shape_statements = statements + [f"{{% for {loop} %}}" for loop in _for_loop_re.findall(text)] \
+                + [f"{{% if {show_if} %}}" for show_if in _showif_re.findall(text)]
+            values = [f"{{{{ {_self_ref_re.sub('vsdx_self.', value)} }}}}" for _, value in _set_self_re.findall(text)]
+            for regex in (_for_loop_re, _showif_re, _set_self_statement_re):
+                text = regex.sub('', text)
+            end_statements = ['{% endfor %}' if st.startswith('{% for') else '{% endif %}' for st in reversed(shape_statements)]
+            source = ''.join(shape_statements + values) + text + ''.join(end_statements)
+            found = meta.find_undeclared_variables(jinja_env.parse(source)) - {'vsdx_self'}
+            if found:
+                shape_variables[s.ID] = found
+            VisioFile._jinja_shape_variables(s, shape_statements, shape_variables)
+
+    def _jinja_finish_page(self, page: VisioFile.Page, output: bytes, loop_shape_ids: list, set_selfs: list, context: dict):
+        # replace page xml with rendered output, then update shapes set or duplicated by vsdx specific statements
+        page.xml = ET.ElementTree(ET.fromstring(output))  # create ElementTree from Element created from output
+
+        # apply 'set self' statements to each rendered copy of their shape
+        for shape_id, property_name, value in set_selfs:
+            for shape in page.find_shapes_by_id(shape_id):  # type: VisioFile.Shape
+                VisioFile.jinja_apply_set_self(shape, property_name, value, context)
+
+        # update loop shape IDs - page max_id was reset when xml was replaced
+        for shape_id in loop_shape_ids:
+            shapes_by_id = page.find_shapes_by_id(shape_id)  # type: List[VisioFile.Shape]
+            if shapes_by_id and len(shapes_by_id) > 1:
+                delta = 0
+                for shape in shapes_by_id[1:]:  # from the 2nd onwards - leaving original unchanged
+                    # increment each new shape duplicated by the jinja loop
+                    self.increment_sub_shape_ids(shape, page)
+                    delta += shape.height  # automatically move each duplicate down
+                    shape.move(0, -delta)  # move duplicated shapes so they are visible
+
+    def _jinja_prepare_page(self, page: VisioFile.Page) -> (str, list, list):
+        # translate vsdx specific statements in page, returning the Jinja source with loop shape IDs and set self
+        # statements - does not depend on context, so the result can be compiled once and rendered many times
+        loop_shape_ids = list()
+        set_selfs = list()
+        for shapes_by_id in page.shapes:  # type: VisioFile.Shape
+            VisioFile.jinja_render_shape(shape=shapes_by_id, context={}, loop_shape_ids=loop_shape_ids,
+                                         set_selfs=set_selfs)
+
+        source = ET.tostring(page.xml.getroot(), encoding='unicode')
+        source = VisioFile.unescape_jinja_statements(source)  # unescape chars like < and > inside {%...%}
+        return source, loop_shape_ids, set_selfs
+
+    def _part_name(self, filename: str) -> str:
+        # name of file within the vsdx package, i.e. 'visio/pages/page1.xml'
+        return os.path.relpath(filename, self.directory).replace(os.sep, '/')
+
+    @staticmethod
+    def compile_template(filename: str, compiled_filename: str):
+        """Preprocess and compile a Jinja template vsdx file, for fast rendering once loaded with :meth:`load_compiled`
+
+        The compiled file contains the original vsdx package parts, plus the preprocessed Jinja source and Jinja
+        bytecode of each page containing Jinja markup
+
+        :param filename: the template vsdx file
+        :type filename: str
+        :param compiled_filename: path to save compiled template file
+        :type compiled_filename: str
+
+        :return: None
+        """
+        manifest = {'pages': []}
+        sources = dict()  # part name: preprocessed source
+        with VisioFile(filename) as vis:
+            for page in vis.pages:  # type: VisioFile.Page
+                if page.contains_jinja():
+                    part_name = vis._part_name(page.filename)
+                    sources[part_name], loop_shape_ids, set_selfs = vis._jinja_prepare_page(page)
+                    manifest['pages'].append({'part': part_name, 'loop_shape_ids': loop_shape_ids, 'set_selfs': set_selfs})
+
+        # compile each page source, which stores the compiled module code in the bytecode cache
+        bytecode = dict()
+        env = jinja_env.overlay(loader=DictLoader(sources), bytecode_cache=_DictBytecodeCache(bytecode))
+        for part_name in sources:
+            env.get_template(part_name)
+
+        with zipfile.ZipFile(filename, 'r') as zip_ref, zipfile.ZipFile(compiled_filename, 'w', zipfile.ZIP_DEFLATED) as zip_out:
+            for info in zip_ref.infolist():
+                zip_out.writestr(info, zip_ref.read(info))  # original package parts
+            zip_out.writestr(f'{compiled_template_dir}/manifest.json', json.dumps(manifest))
+            for part_name, source in sources.items():
+                zip_out.writestr(f'{compiled_template_dir}/{part_name}', source)
+            for key, code in bytecode.items():
+                zip_out.writestr(f'{compiled_template_dir}/bytecode/{key}', code)
+
     @staticmethod
-    def jinja_render_shape(shape: VisioFile.Shape, context: dict, loop_shape_ids: list):
+    def load_compiled(compiled_filename: str, debug: bool = False) -> VisioFile:
+        """Load a template file created by :meth:`compile_template`
+
+        :meth:`jinja_render_vsdx` renders pages of the returned VisioFile with the precompiled templates, without
+        parsing or preprocessing them
+
+        :param compiled_filename: the compiled template file
+        :type compiled_filename: str
+        :param debug: enable/disable debugging
+        :type debug: bool, default to False
+
+        :return: :class:`VisioFile`
+        """
+        vis = VisioFile(compiled_filename, debug=debug)
+        compiled_dir = f'{vis.directory}/{compiled_template_dir}'
+        with open(f'{compiled_dir}/manifest.json') as f:
+            manifest = json.load(f)
+        sources = dict()
+        for page_info in manifest['pages']:
+            with open(f"{compiled_dir}/{page_info['part']}", encoding='utf-8') as f:
+                sources[page_info['part']] = f.read()
+        bytecode = dict()
+        bytecode_dir = f'{compiled_dir}/bytecode'
+        for key in (os.listdir(bytecode_dir) if os.path.exists(bytecode_dir) else []):
+            with open(f'{bytecode_dir}/{key}', 'rb') as f:
+                bytecode[key] = f.read()
+        shutil.rmtree(compiled_dir)  # not part of the vsdx package, so must not be included when saved
+
+        env = jinja_env.overlay(loader=DictLoader(sources), bytecode_cache=_DictBytecodeCache(bytecode))
+        pages = {vis._part_name(page.filename): page for page in vis.pages}
+        for page_info in manifest['pages']:
+            page = pages.get(page_info['part'])
+            if page:
+                set_selfs = [tuple(set_self) for set_self in page_info['set_selfs']]
+                page._jinja_compiled = (sources[page_info['part']], env.get_template(page_info['part']),
+                                        page_info['loop_shape_ids'], set_selfs)
+        return vis
+
+    @staticmethod
+    def jinja_render_shape(shape: VisioFile.Shape, context: dict, loop_shape_ids: list, set_selfs: Optional[list] = None):
         prev_shape = None
         for s in shape.sub_shapes():  # type: VisioFile.Shape
             # manage for loops in template
@@ -619,40 +1117,42 @@ class VisioFile:
             if loop_shape_id:
                 loop_shape_ids.append(loop_shape_id)
             prev_shape = s
-            # manage 'set self' statements
-            VisioFile.jinja_set_selfs(s, context)
-            VisioFile.jinja_render_shape(shape=s, context=context, loop_shape_ids=loop_shape_ids)
+            # manage 'set self' statements - apply now, or record as (shape ID, property, value) to apply later
+            if set_selfs is None:
+                VisioFile.jinja_set_selfs(s, context)
+            else:
+                set_selfs.extend((s.ID, property_name, value) for property_name, value in VisioFile.jinja_remove_set_selfs(s))
+            VisioFile.jinja_render_shape(shape=s, context=context, loop_shape_ids=loop_shape_ids, set_selfs=set_selfs)
 
     @staticmethod
     def jinja_set_selfs(shape: VisioFile.Shape, context: dict):
         # apply any {% self self.xxx = yyy %} statements in shape properties
+        for property_name, value in VisioFile.jinja_remove_set_selfs(shape):
+            VisioFile.jinja_apply_set_self(shape, property_name, value, context)
+
+    @staticmethod
+    def jinja_remove_set_selfs(shape: VisioFile.Shape) -> List[tuple]:
+        # remove any {% set self %} statements, leaving any remaining text, and return them as (property, value)
         jinja_source = shape.text
-        matches = re.findall('{% set self.(.*?)\s?=\s?(.*?) %}', jinja_source)  # non-greedy search for all {%...%} strings
-        for m in matches:  # type: tuple  # expect ('property', 'value') such as ('x', '10') or ('y', 'n*2')
-            property_name = m[0]
-            value = "{{ "+m[1]+" }}"  # Jinja to be processed
-            # todo: replace any self references in value with actual value - i.e. {% set self.x = self.x+1 %}
-            self_refs = re.findall('self.(.*)[\s+-/*//]?', m[1])  # greedy search for all self.? between +, -, *, or /
-            for self_ref in self_refs:  # type: tuple  # expect ('property', 'value') such as ('x', '10') or ('y', 'n*2')
-                ref_val = str(shape.__getattribute__(self_ref[0]))
-                value = value.replace('self.'+self_ref[0], ref_val)
-            # use Jinja template to calculate any self refs found
-            template = Template(value)  # value might be '{{ 1.0+2.4*3 }}'
-            value = template.render(context)
-            if property_name in ['x', 'y']:
-                shape.__setattr__(property_name, value)
-
-        # remove any {% set self %} statements, leaving any remaining text
-        matches = re.findall('{% set self.*?%}', jinja_source)
-        for m in matches:
+        matches = _set_self_re.findall(jinja_source)  # expect ('property', 'value') such as ('x', '10') or ('y', 'n*2')
+        for m in _set_self_statement_re.findall(jinja_source):
             jinja_source = jinja_source.replace(m, '')  # remove Jinja 'set self' statement
         shape.text = jinja_source
+        return matches
+
+    @staticmethod
+    def jinja_apply_set_self(shape: VisioFile.Shape, property_name: str, value: str, context: dict):
+        # evaluate value with any self references resolved against this shape - i.e. {% set self.x = self.x+1 %}
+        expression = compile_jinja_expression(_self_ref_re.sub('vsdx_self.', value))  # value might be '1.0+2.4*3'
+        value = str(expression(context, vsdx_self=shape))
+        if property_name in ['x', 'y']:
+            shape.__setattr__(property_name, value)
 
     @staticmethod
     def unescape_jinja_statements(jinja_source):
         # unescape any text between {% ... %}
         jinja_source_out = jinja_source
-        matches = re.findall('{%(.*?)%}', jinja_source)  # non-greedy search for all {%...%} strings
+        matches = _statement_re.findall(jinja_source)  # non-greedy search for all {%...%} strings
         for m in matches:
             unescaped = m.replace('&gt;', '>').replace('&lt;', '<')
             jinja_source_out = jinja_source_out.replace(m, unescaped)
@@ -665,7 +1165,7 @@ class VisioFile:
         text = shape.text
 
         # use regex to find all loops
-        jinja_loops = re.findall("{% for\s(.*?)\s%}", text)
+        jinja_loops = _for_loop_re.findall(text)
 
         for loop in jinja_loops:
             jinja_loop_text = f"{{% for {loop} %}}"
@@ -688,7 +1188,7 @@ class VisioFile:
             else:
                 shape.xml.tail = '{% endfor %}'
 
-        jinja_show_ifs = re.findall("{% showif\s(.*?)\s%}", text)  # find all showif statements
+        jinja_show_ifs = _showif_re.findall(text)  # find all showif statements
         # jinja_show_if - translate non-standard {% showif statement %} to valid jinja if statement
         for show_if in jinja_show_ifs:
             jinja_show_if = f"{{% if {show_if} %}}"  # translate to actual jinja if statement
@@ -713,21 +1213,17 @@ class VisioFile:
     @staticmethod
     def jinja_page_showif(page: VisioFile.Page, context: dict):
         text = page.name
-        jinja_source = re.findall("{% showif\s(.*?)\s%}", text)
+        jinja_source = _showif_re.findall(text)
         if len(jinja_source):
             # process last matching value
-            template_source = "{{ "+jinja_source[-1]+" }}"
-            template = Template(template_source)  # value might be '{{ 1.0+2.4*3 }}'
-            value = template.render(context)
+            expression = compile_jinja_expression(jinja_source[-1])  # value might be '1.0+2.4*3'
+            value = str(expression(context))
             # is the value truthy - i.e. not 0, False, or empty string, tuple, list or dict
-            print(f"jinja_page_showif(context={context}) statement: {template_source} returns: {type(value)} {value}")
             if value in ['False', '0', '', '()', '[]', '{}']:
-                print("value in ['False', '0', '', '()', '[]', '{}']")
                 return False  # page should be hidden
             # remove jinja statement from page name
-            jinja_statement = re.match("{%.*?%}", page.name)[0]
+            jinja_statement = _statement_re.match(page.name)[0]
             page.set_name(page.name.replace(jinja_statement, ''))
-            print(f"jinja_statement={jinja_statement} page.name={page.name}")
         return True  # page should be left in
 
     @staticmethod
@@ -735,13 +1231,9 @@ class VisioFile:
         return shape.attrib['ID']
 
     def increment_sub_shape_ids(self, shape: VisioFile.Shape, page, id_map: dict = None):
+        # give shape and all its sub shapes new IDs, then update references with the complete map in one pass
         id_map = self.increment_shape_ids(shape.xml, page, id_map)
         self.update_ids(shape.xml, id_map)
-        for s in shape.sub_shapes():
-            id_map = self.increment_shape_ids(s.xml, page, id_map)
-            self.update_ids(s.xml, id_map)
-            if s.sub_shapes():
-                id_map = self.increment_sub_shape_ids(s, page, id_map)
         return id_map
 
     def copy_shape(self, shape: Element, page: ET, page_path: str) -> ET:
@@ -758,13 +1250,12 @@ class VisioFile:
             ElementTree: The new shape ElementTree
 
         """
-
+        self._check_writable()
         new_shape = ET.fromstring(ET.tostring(shape))
 
         for page_obj in self.pages:
             if page_obj.filename == page_path:
                 break
-        page_obj.set_max_ids()
 
         # find or create Shapes tag
         shapes_tag = page.find(f"{namespace}Shapes")
@@ -780,6 +1271,7 @@ class VisioFile:
 
     def insert_shape(self, shape: Element, shapes: Element, page: ET, page_path: str) -> ET:
         # insert shape into shapes tag, and return updated shapes tag
+        self._check_writable()
         for page_obj in self.pages:
             if page_obj.filename == page_path:
                 break
@@ -790,12 +1282,10 @@ class VisioFile:
         return shapes
 
     def increment_shape_ids(self, shape: Element, page: VisioFile.Page, id_map: dict=None):
+        # give shape and every sub shape, at any depth, a new ID - mapping each old ID to its new ID
         if id_map is None:
             id_map = dict()
-        self.set_new_id(shape, page, id_map)
-        for e in shape.findall(f"{namespace}Shapes"):
-            self.increment_shape_ids(e, page, id_map)
-        for e in shape.findall(f"{namespace}Shape"):
+        for e in list(shape.iter(f"{namespace}Shape")):
             self.set_new_id(e, page, id_map)
 
         return id_map
@@ -810,23 +1300,101 @@ class VisioFile:
         return max_id  # return new id for info
 
     def update_ids(self, shape: Element, id_map: dict):
-        # update: <ns0:Cell F="Sheet.15! replacing 15 with new id using prepopulated id_map
-        # cycle through shapes looking for Cell tag inside a Shape tag, which may be inside a Shapes tag
-        for e in shape.findall(f"{namespace}Shapes"):
-            self.update_ids(e, id_map)
-        for e in shape.findall(f"{namespace}Shape"):
-            # look for Cell elements
-            cells = e.findall(f"{namespace}Cell[@F]")
-            for cell in cells:
-                f = str(cell.attrib['F'])
-                if f.startswith("Sheet."):
-                    # update sheet refs with new ids
-                    shape_id = f.split('!')[0].split('.')[1]
-                    new_id = id_map[shape_id]
-                    new_f = f.replace(f"Sheet.{shape_id}",f"Sheet.{new_id}")
-                    cell.attrib['F'] = new_f
+        # update: <ns0:Cell F="Sheet.15!Width" replacing 15 with new id using prepopulated id_map
+        # every reference in every cell formula within shape is updated, references to ids not in id_map are unchanged
+        def new_ref(m: re.Match) -> str:
+            new_id = id_map.get(m.group(1))
+            return f"Sheet.{new_id}!" if new_id is not None else m.group(0)
+
+        for cell in shape.iter(f"{namespace}Cell"):
+            f = cell.attrib.get('F')
+            if f and 'Sheet.' in f:
+                cell.attrib['F'] = _sheet_ref_re.sub(new_ref, f)
         return shape
 
+    def freeze(self) -> VisioFile:
+        """Make this VisioFile read only, so that it can be queried from many threads at the same time without locks
+
+        All pages and master pages are loaded, and the shapes, connects and ID lookups of each page are built once
+        and reused. Methods that would change the VisioFile raise :class:`ReadOnlyError`, use :meth:`clone` to get a
+        copy that can be changed.
+
+        :return: this :class:`VisioFile`
+        """
+        for page in self.pages + self.master_pages:  # type: VisioFile.Page
+            page._freeze()
+        self._master_index = dict()
+        for master in self.master_pages:
+            self._master_index.setdefault(master.name, master)
+        self._page_indexes()
+        self.read_only = True
+        return self
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ReadOnlyError(f"VisioFile({self.filename}) is read only")
+
+    def clone(self) -> VisioFile:
+        """Create an independent copy of this VisioFile, without unzipping or parsing the vsdx file again
+
+        Page and master page trees already loaded are copied, so changes to the copy don't affect this VisioFile.
+        The copy has its own extracted files, and shares media parts left in the vsdx file.
+        For example, a template loaded once can be cloned and rendered with :meth:`jinja_render_vsdx` for
+        each context.
+
+        :return: :class:`VisioFile` - which should be closed or saved when no longer needed
+        """
+        vis = VisioFile.__new__(VisioFile)
+        vis._copy_from(self, tempfile.mkdtemp(prefix=f"{_file_stem(self.filename)}_"))
+        return vis
+
+    def snapshot(self) -> VisioFile:
+        """Take a copy of the current state of this VisioFile, to be restored later by :meth:`restore`
+
+        :return: :class:`VisioFile` - a clone, which should not be modified, and closed when no longer needed
+        """
+        return self.clone()
+
+    def restore(self, snapshot: VisioFile):
+        """Return this VisioFile to the state saved by :meth:`snapshot`, even if it has since been saved and closed
+
+        The snapshot is unchanged, so can be restored again
+
+        :param snapshot: a VisioFile returned by :meth:`snapshot`
+        :type snapshot: :class:`VisioFile`
+
+        :return: None
+        """
+        self._check_writable()
+        self.close_vsdx()
+        self._copy_from(snapshot, self.directory)
+
+    def _copy_from(self, vis: VisioFile, directory: str):
+        _copy_directory(vis.directory, directory)
+        self.debug = vis.debug
+        self.filename = vis.filename
+        self.directory = directory
+        self.read_only = False
+        self._master_index = None
+        self._pages_changed()
+        self._passthrough_parts = set(vis._passthrough_parts)
+        self.pages_xml = _copy_xml(vis.pages_xml)
+        self.pages_xml_rels = _copy_xml(vis.pages_xml_rels)
+        self.content_types_xml = _copy_xml(vis.content_types_xml)
+        self.app_xml = _copy_xml(vis.app_xml)
+
+        def page_filename(page: VisioFile.Page):
+            return os.path.join(directory, os.path.relpath(page.filename, vis.directory))
+
+        self.pages = list()
+        for page in vis.pages:  # type: VisioFile.Page
+            new_page = VisioFile.Page(_copy_xml(page._xml), page_filename(page), page.name, self)
+            new_page._jinja_compiled = page._jinja_compiled  # compiled templates are not modified when rendered
+            new_page._max_id = page._max_id
+            self.pages.append(new_page)
+        self.master_pages = [VisioFile.Page(_copy_xml(page._xml), page_filename(page), page.name, self)
+                             for page in vis.master_pages]
+
     def close_vsdx(self):
         try:
             # Remove extracted folder
@@ -834,25 +1402,49 @@ class VisioFile:
         except (FileNotFoundError, PermissionError):
             pass
 
-    def save_vsdx(self, new_filename=None):
+    def save_vsdx(self, new_filename=None, workers: Optional[int] = None, compression: int = zipfile.ZIP_DEFLATED,
+                  compresslevel: Optional[int] = None):
         """save the VisioFile object as new vsdx file
 
         :param new_filename: path to save vsdx file
         :type new_filename: str
-
+        :param workers: number of threads used to compress files in the vsdx file
+        :type workers: int, optional - default of None uses ThreadPoolExecutor default
+        :param compression: zipfile.ZIP_DEFLATED, or zipfile.ZIP_STORED to save without compression.
+            Already compressed media, such as png and jpeg images, is always stored
+        :type compression: int, default zipfile.ZIP_DEFLATED
+        :param compresslevel: zlib compression level, 0 to 9
+        :type compresslevel: int, optional - default of None uses zlib default
+
+        As an optimisation, on the Python versions listed in `vsdx.raw_zip_versions`, files are compressed in
+        parallel threads and parts left in the source file are copied without decompressing them. This uses private
+        zipfile internals, so other Python versions compress files one at a time with the public zipfile API.
         """
+        # pages never loaded are unchanged, so left as extracted
+        self._save_vsdx(new_filename, pages=[page for page in self.pages if page._xml is not None],
+                        workers=workers, compression=compression, compresslevel=compresslevel)
+        self.close_vsdx()
+
+    def _save_vsdx(self, new_filename, pages: List[VisioFile.Page], workers: Optional[int] = None,
+                   compression: int = zipfile.ZIP_DEFLATED, compresslevel: Optional[int] = None):
+        # save as new vsdx file, writing only the pages listed, without closing the VisioFile
+        self._check_writable()
+        if compression not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            raise ValueError(f"compression must be zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED, not {compression}")
+
         # write pages.xml.rels
         xml_to_file(self.pages_xml_rels, f'{self.directory}/visio/pages/_rels/pages.xml.rels')
 
         # write pages.xml file - in case pages added removed
         xml_to_file(self.pages_xml, self._pages_filename())
 
-        # write the master pages to file
+        # write the master pages to file - masters never loaded are unchanged, so left as extracted
         for page in self.master_pages:  # type: VisioFile.Page
-            xml_to_file(page.xml, page.filename)
+            if page._xml is not None:
+                xml_to_file(page.xml, page.filename)
 
         # write the pages to file
-        for page in self.pages:  # type: VisioFile.Page
+        for page in pages:  # type: VisioFile.Page
             xml_to_file(page.xml, page.filename)
 
         # write [content_Types].xml
@@ -863,20 +1455,56 @@ class VisioFile:
             xml_to_file(self.app_xml, f'{self.directory}/docProps/app.xml')
 
         # wrap up files into zip and rename to vsdx
-        base_filename = self.filename[:-5]  # remove ".vsdx" from end
+        base_filename = self.directory  # unique for each VisioFile, so the same file can be saved at the same time
         if new_filename.find(os.sep) > 0:
             directory = new_filename[0:new_filename.rfind(os.sep)]
             if directory:
                 if not os.path.exists(directory):
                     os.mkdir(directory)
-        shutil.make_archive(base_filename, 'zip', self.directory)
+        self._write_zip(base_filename + '.zip', workers, compression, compresslevel)
         if not new_filename:
-            shutil.move(base_filename + '.zip', base_filename + '_new.vsdx')
+            shutil.move(base_filename + '.zip', self.filename[:-5] + '_new.vsdx')
         else:
             if new_filename[-5:] != '.vsdx':
                 new_filename += '.vsdx'
             shutil.move(base_filename + '.zip', new_filename)
-        self.close_vsdx()
+
+    def _write_zip(self, zip_filename: str, workers: Optional[int], compression: int, compresslevel: Optional[int]):
+        # zip extracted files, compressing them in parallel threads - zlib releases the GIL while compressing
+        filenames = list()
+        for root, dirs, files in os.walk(self.directory):
+            dirs.sort()
+            filenames.extend(os.path.join(root, name) for name in sorted(files))
+        filenames.sort(key=lambda filename: self._part_name(filename) != '[Content_Types].xml')  # first by convention
+
+        level = zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor, zipfile.ZipFile(zip_filename, 'w') as zip_out:
+            raw_access = _zip_raw_access(zip_out)
+            pending = deque()  # futures in order of filenames, limited so compressed files don't all wait in memory
+            for filename in filenames:
+                if not raw_access:  # compress with zipfile, one file at a time
+                    _write_file(zip_out, self._part_name(filename), filename, compression, level)
+                    continue
+                pending.append((filename, executor.submit(_compress_file, filename, compression, level)))
+                if len(pending) > max_pending:
+                    _write_compressed(zip_out, self._part_name(pending[0][0]), *pending.popleft())
+            while pending:
+                _write_compressed(zip_out, self._part_name(pending[0][0]), *pending.popleft())
+
+            # copy compressed data of parts not extracted, unless replaced by an extracted file
+            # or compressed differently to extracted files
+            passthrough_parts = set(self._passthrough_parts) - set(self._part_name(f) for f in filenames)
+            if passthrough_parts:
+                with zipfile.ZipFile(self.filename, 'r') as zip_in:
+                    for info in zip_in.infolist():
+                        if info.filename not in passthrough_parts:
+                            continue
+                        compress_type = _compress_type(info.filename, compression)
+                        if raw_access and info.compress_type == compress_type:
+                            _copy_raw_member(zip_in, zip_out, info)
+                        else:  # compressed differently in source file, so decompress and compress again
+                            _recompress_member(zip_in, zip_out, info, compress_type, level)
 
     class Cell:
         def __init__(self, xml: Element, shape: VisioFile.Shape):
@@ -889,6 +1517,7 @@ class VisioFile:
 
         @value.setter
         def value(self, value: str):
+            self.shape.page.vis._check_writable()
             self.xml.attrib['V'] = str(value)
 
         @property
@@ -922,6 +1551,7 @@ class VisioFile:
                 self.master_page_ID = parent.master_page_ID
             self.shape_type = xml.attrib.get('Type', None)
             self.page = page
+            self._sub_shapes = None  # built once by Page._freeze()
 
             # get Cells in Shape
             self.cells = dict()
@@ -943,6 +1573,7 @@ class VisioFile:
 
             :return: :class:`Shape` the new copy of shape
             """
+            self.page.vis._check_writable()
             dst_page = page or self.page
             new_shape_xml = self.page.vis.copy_shape(self.xml, dst_page.xml, dst_page.filename)
 
@@ -956,6 +1587,57 @@ class VisioFile:
 
             return VisioFile.Shape(xml=new_shape_xml, parent=parent, page=dst_page)
 
+        def copy_many(self, n: int, offsets=None) -> List[VisioFile.Shape]:
+            """Add n copies of this Shape, or group, next to it in the same Shapes tag, and return the copies
+
+            Each copy is given new shape IDs, and 'Sheet.N!' references in its formulas to shapes within the copy
+            are updated to the new IDs.
+
+            :param n: the number of copies
+            :type n: int
+            :param offsets: either one (dx, dy) step, so that copy i is moved by i+1 steps from this shape,
+                or a list of n (dx, dy) moves, one for each copy. Copies are not moved if not specified.
+            :type offsets: tuple or list of tuple (Optional)
+
+            :return: list of the new :class:`Shape` objects
+            """
+            self.page.vis._check_writable()
+            if offsets is None:
+                offsets = [None] * n
+            elif offsets and isinstance(offsets[0], (int, float)):
+                dx, dy = offsets
+                offsets = [(dx * (i + 1), dy * (i + 1)) for i in range(n)]
+            elif len(offsets) != n:
+                raise ValueError(f"Expected {n} offsets, got {len(offsets)}")
+
+            shapes_tag = self.parent.xml
+            if shapes_tag.tag != f"{namespace}Shapes":  # parent is the group containing this shape
+                shapes_tag = shapes_tag.find(f"{namespace}Shapes")
+            x, y = (self.x or 0, self.y or 0) if any(offsets) else (None, None)
+            page = self.page
+            shape_ids = [e.attrib['ID'] for e in self.xml.iter(f"{namespace}Shape")]
+
+            new_elements = list()
+            for offset in offsets:
+                e = copy.deepcopy(self.xml)
+                id_map = dict()
+                for shape_id, shape in zip(shape_ids, e.iter(f"{namespace}Shape")):
+                    page.max_id += 1
+                    id_map[shape_id] = page.max_id
+                    shape.attrib['ID'] = str(page.max_id)
+                page.vis.update_ids(e, id_map)
+                if offset:
+                    for name, value in (('PinX', x + offset[0]), ('PinY', y + offset[1])):
+                        cell = e.find(f'{namespace}Cell[@N="{name}"]')
+                        if cell is None:  # position inherited from master
+                            cell = Element(f"{namespace}Cell", {'N': name})
+                            e.insert(0, cell)
+                        cell.attrib['V'] = str(value)
+                        cell.attrib.pop('F', None)
+                new_elements.append(e)
+            shapes_tag.extend(new_elements)
+            return [VisioFile.Shape(xml=e, parent=self.parent, page=page) for e in new_elements]
+
         @property
         def master_shape(self) -> VisioFile.Shape:
             """Get this shapes master
@@ -995,6 +1677,7 @@ class VisioFile:
                 return self.master_shape.cell_value(name)
 
         def set_cell_value(self, name: str, value: str):
+            self.page.vis._check_writable()
             cell = self.cells.get(name)
             if cell:  # only set value of existing item
                 cell.value = value
@@ -1113,6 +1796,7 @@ class VisioFile:
 
         @text.setter
         def text(self, value):
+            self.page.vis._check_writable()
             text_element = self.xml.find(f"{namespace}Text")
             if isinstance(text_element, Element):  # if there is a Text element then clear out and set contents
                 VisioFile.Shape.clear_all_text_from_xml(text_element)
@@ -1120,6 +1804,8 @@ class VisioFile:
             # todo: create new Text element if not found
 
         def sub_shapes(self):
+            if self._sub_shapes is not None:
+                return self._sub_shapes
             shapes = list()
             # for each shapes tag, look for Shape objects
             # self can be either a Shapes or a Shape
@@ -1222,10 +1908,12 @@ class VisioFile:
                 s.find_replace(old, new)
 
         def remove(self):
+            self.page.vis._check_writable()
             self.parent.xml.remove(self.xml)
 
         def append_shape(self, append_shape: VisioFile.Shape):
             # insert shape into shapes tag, and return updated shapes tag
+            self.page.vis._check_writable()
             id_map = self.page.vis.increment_shape_ids(append_shape.xml, self.page)
             self.page.vis.update_ids(append_shape.xml, id_map)
             self.xml.append(append_shape.xml)
@@ -1274,36 +1962,91 @@ class VisioFile:
         :type connects: List of :class:`Connect`
 
         """
-        def __init__(self, xml: ET.ElementTree, filename: str, page_name: str, vis: VisioFile):
+        def __init__(self, xml: Optional[ET.ElementTree], filename: str, page_name: str, vis: VisioFile):
 
-            self._xml = xml
+            self._xml = xml  # None until first accessed, then loaded from filename
             self.filename = filename
             self.name = page_name
             self.vis = vis
-            self.connects = self.get_connects()
-            self.max_id = 0
+            self._connects = None
+            self._jinja_compiled = None  # (source, template, loop_shape_ids, set_selfs) set by load_compiled()
+            self._max_id = None  # highest shape ID in page, found when first needed then kept current
+            self._shapes = None  # list of Shape, built once by _freeze()
+            self._shape_index = None  # shape ID: first Shape found with that ID, built by _freeze()
 
         def __repr__(self):
             return f"<Page name={self.name} file={self.filename} >"
 
         def set_name(self, value: str):
             # todo: change to name property
-            pages_filename = self.vis._pages_filename()  # pages contains Page name, width, height, mapped to Id
-            pages = file_to_xml(pages_filename)  # this contains a list of pages with rel_id and filename
-            page = pages.getroot().find(f"{namespace}Page[{self.index_num + 1}]")
-            #print(f"set_name() page={VisioFile.pretty_print_element(page)}")
-            if page:
+            self.vis._check_writable()
+            # pages.xml contains Page name, width, height, mapped to Id, in the same order as VisioFile.pages
+            index = self.index_num
+            pages = self.vis.pages_xml.getroot()
+            page = pages[index] if index < len(pages) and pages[index].tag == f"{namespace}Page" else \
+                pages.find(f"{namespace}Page[{index + 1}]")
+            if page is not None:
                 page.attrib['Name'] = value
+                old_name = self.name
                 self.name = value
-                self.vis.pages_xml = pages
+                if self.vis.app_xml:
+                    self.vis._rename_page_in_app_xml(old_name, value)
+                page_names, page_positions = self.vis._page_indexes()
+                if page_names.get(old_name) is self:
+                    del page_names[old_name]  # any other page with old name is found by get_page_by_name()
+                other = page_names.get(value)
+                if other is None or other.name != value or page_positions.get(other, index + 1) > index:
+                    page_names[value] = self
 
         @property
         def xml(self):
+            if self._xml is None:
+                self.vis._extract_part(self.filename)
+                self._xml = file_to_xml(self.filename)
             return self._xml
 
         @xml.setter
         def xml(self, value):
+            self.vis._check_writable()
             self._xml = value
+            self._connects = None
+            self._max_id = None
+
+        @property
+        def connects(self) -> List[VisioFile.Connect]:
+            if self._connects is None:
+                self._connects = self.get_connects()
+            return self._connects
+
+        def contains_jinja(self) -> bool:
+            """Check whether this page, or a master page it uses, contains any Jinja markup
+
+            A page which has not been loaded yet is checked by scanning the raw bytes of its file, without parsing it
+
+            :return: True if the page needs to be rendered by :meth:`VisioFile.jinja_render_vsdx`
+            """
+            if self._xml is None:
+                self.vis._extract_part(self.filename)
+                with open(self.filename, 'rb') as f:
+                    data = f.read()
+                if any(marker.encode() in data for marker in jinja_markers):
+                    return True
+                master_ids = set(m.decode() for m in _master_ref_re.findall(data))
+            else:
+                master_ids = set()
+                for e in self._xml.getroot().iter():
+                    for text in (e.text, e.tail, *e.attrib.values()):
+                        if text and any(marker in text for marker in jinja_markers):
+                            return True
+                    if e.attrib.get('Master'):
+                        master_ids.add(e.attrib['Master'])
+
+            for master_id in master_ids:
+                # text inherited from a master shape is part of the template too
+                master_page = self.vis.get_master_page_by_id(master_id)
+                if master_page and master_page.contains_jinja():
+                    return True
+            return False
 
         @property
         def shapes(self):
@@ -1312,22 +2055,61 @@ class VisioFile:
             Note: typically returns one :class:`Shape` object which itself contains :class:`Shape` objects
 
             """
+            if self._shapes is not None:
+                return self._shapes
             return [VisioFile.Shape(xml=shapes, parent=self, page=self) for shapes in self.xml.findall(f"{namespace}Shapes")]
 
-        def set_max_ids(self):
-            # get maximum shape id from xml in page
-            for shapes in self.shapes:
-                for shape in shapes.sub_shapes():
-                    id = shape.get_max_id()
-                    if id > self.max_id:
-                        self.max_id = id
+        def _freeze(self):
+            # build shapes, connects and shape ID index once, so that they can be shared by threads
+            def freeze_shape(shape: VisioFile.Shape):
+                shape._sub_shapes = shape.sub_shapes()
+                for s in shape._sub_shapes:
+                    self._shape_index.setdefault(s.ID, s)  # same shape as found by find_shape_by_id()
+                    if s.shape_type == 'Group':
+                        freeze_shape(s)
+
+            self._shape_index = dict()
+            shapes = self.shapes
+            for shape in shapes:
+                freeze_shape(shape)
+            self._shapes = shapes
+            self.connects  # load connects
+
+        @property
+        def max_id(self) -> int:
+            """The highest shape ID in the page
+
+            Found with a single pass over the page xml when first used, then incremented as new shape IDs are
+            assigned, so that adding shapes does not search the page each time
+
+            """
+            if self._max_id is None:
+                self._max_id = max((int(e.attrib['ID']) for e in self.xml.getroot().iter(f"{namespace}Shape")
+                                    if e.attrib.get('ID', '').isdigit()), default=0)
+            return self._max_id
 
+        @max_id.setter
+        def max_id(self, value: int):
+            self.vis._check_writable()
+            self._max_id = value
+
+        def set_max_ids(self):
+            # get maximum shape id from xml in page, including any shapes added to the xml directly
+            self._max_id = None
             return self.max_id
 
         @property
         def index_num(self):
             # return zero-based index of this page in parent VisioFile.pages list
-            return self.vis.pages.index(self)
+            pages = self.vis.pages
+            index = self.vis._page_indexes()[1].get(self)
+            if index is None or index >= len(pages) or pages[index] is not self:
+                # pages list changed directly, so rebuild index
+                self.vis._pages_changed()
+                index = self.vis._page_indexes()[1].get(self)
+                if index is None:
+                    raise ValueError(f"{self} is not in pages")
+            return index
 
         def get_connects(self):
             elements = self.xml.findall(f".//{namespace}Connect")  # search recursively
@@ -1355,6 +2137,8 @@ class VisioFile:
                 s.find_replace(old, new)
 
         def find_shape_by_id(self, shape_id) -> VisioFile.Shape:
+            if self._shape_index is not None:
+                return self._shape_index.get(shape_id)
             for s in self.shapes:
                 found = s.find_shape_by_id(shape_id)
                 if found:
@@ -1393,6 +2177,840 @@ class VisioFile:
                     shapes.extend(found)
             return shapes
 
+        def add_shapes_from_master(self, master_id: str, rows: Iterable[dict]) -> List[VisioFile.Shape]:
+            """Add an instance of a master shape to the page for each row of data
+
+            :param master_id: ID of the master page, as used by :meth:`VisioFile.get_master_page_by_id`
+            :type master_id: str
+            :param rows: dicts with optional 'x' and 'y' position, 'text', and 'cells' dict of cell name: value
+            :type rows: iterable of dict
+
+            :return: list of the new :class:`Shape` objects
+            """
+            self.vis._check_writable()
+            master_page = self.vis.get_master_page_by_id(master_id)
+            if master_page is None:
+                raise ValueError(f"Master page with ID '{master_id}' not found")
+            self._add_master_rel(master_page)
+
+            # instance shape, which inherits everything else from master shape and its sub shapes
+            def instance(master_shape: Element, attributes: dict) -> Element:
+                e = Element(f"{namespace}Shape", attributes)
+                master_sub_shapes = master_shape.findall(f"{namespace}Shapes/{namespace}Shape")
+                if master_sub_shapes:
+                    sub_shapes = ET.SubElement(e, f"{namespace}Shapes")
+                    for s in master_sub_shapes:
+                        sub_shapes.append(instance(s, {'ID': '', 'Type': s.attrib.get('Type', 'Shape'),
+                                                       'MasterShape': s.attrib.get('ID')}))
+                return e
+
+            master_shape = master_page.xml.getroot().find(f"{namespace}Shapes/{namespace}Shape")
+            prototype = instance(master_shape, {'ID': '', 'Type': master_shape.attrib.get('Type', 'Shape'),
+                                                'Master': master_id})
+
+            new_elements = list()
+            for row in rows:
+                e = copy.deepcopy(prototype)
+                for shape in e.iter(f"{namespace}Shape"):
+                    self.max_id += 1
+                    shape.attrib['ID'] = str(self.max_id)
+                cells = dict(row.get('cells', {}))
+                if 'x' in row:
+                    cells['PinX'] = row['x']
+                if 'y' in row:
+                    cells['PinY'] = row['y']
+                for i, (name, value) in enumerate(cells.items()):
+                    e.insert(i, Element(f"{namespace}Cell", {'N': name, 'V': str(value)}))
+                if 'text' in row:
+                    text = Element(f"{namespace}Text")
+                    text.text = str(row['text'])
+                    e.insert(len(cells), text)  # after cells, before any sub shapes
+                new_elements.append(e)
+
+            shapes_tag = self.xml.getroot().find(f"{namespace}Shapes")
+            if shapes_tag is None:
+                shapes_tag = ET.SubElement(self.xml.getroot(), f"{namespace}Shapes")
+            shapes_tag.extend(new_elements)
+            parent = VisioFile.Shape(xml=shapes_tag, parent=self, page=self)
+            return [VisioFile.Shape(xml=e, parent=parent, page=self) for e in new_elements]
+
+        def _add_master_rel(self, master_page: VisioFile.Page):
+            # add relationship from page to master page, if not already related
+            self.vis._extract_part(self.filename)  # rels file may still be in the vsdx file if the page isn't loaded
+            rels_filename = os.path.join(os.path.dirname(self.filename), '_rels', os.path.basename(self.filename) + '.rels')
+            rels_namespace = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+            target = f"../masters/{os.path.basename(master_page.filename)}"
+            rels = file_to_xml(rels_filename) if os.path.exists(rels_filename) else \
+                ET.ElementTree(Element(f"{rels_namespace}Relationships"))
+            if any(rel.attrib.get('Target') == target for rel in rels.getroot()):
+                return
+            max_relid = max((int(rel.attrib['Id'][3:]) for rel in rels.getroot()), default=0)  # 'rIdXX' -> XX
+            rels.getroot().append(Element(f"{rels_namespace}Relationship", {
+                'Id': f'rId{max_relid + 1}',
+                'Type': 'http://schemas.microsoft.com/visio/2010/relationships/master',
+                'Target': target,
+            }))
+            os.makedirs(os.path.dirname(rels_filename), exist_ok=True)
+            xml_to_file(rels, rels_filename)
+
+        def property_table(self) -> dict:
+            """Get the data properties of every shape in the page as columns, including properties inherited from
+            master shapes
+
+            Only shapes with at least one data property are included. Values are as stored in the vsdx file, so
+            the type is a Visio type number such as '0' for a string
+
+            :return: dict with 'ID' list of shape IDs, and 'properties' dict of property name: dict of 'label',
+                'value' and 'type' lists - each list has a value, or None, for each shape ID
+            """
+            table = {'ID': list(), 'properties': dict()}
+            for shape_id, properties in self._property_rows(dict()):
+                VisioFile._add_property_row(table, shape_id, properties)
+            return table
+
+        def bind_properties(self, rows: Iterable[dict], key: str) -> list:
+            """Set data property values of shapes from rows of data, such as records exported from a database
+
+            Each row is matched to every shape whose `key` property value equals the row's `key` value, and each other
+            value in the row is set as the Value of the shape property with the same name. Property rows are created
+            where a shape does not have the property, or only inherits it from its master shape.
+            Names may be given with or without the 'Prop.' prefix used in Visio formulas, i.e. 'Prop.AssetTag'
+
+            :param rows: dicts of property name: value, each including the key property
+            :type rows: iterable of dict
+            :param key: name of property used to match rows to shapes
+            :type key: str
+
+            :return: list of key values of rows not matched to any shape
+            """
+            self.vis._check_writable()
+            key = key[5:] if key.startswith('Prop.') else key
+
+            # index shapes by key property value, including values inherited from master shapes
+            index = dict()  # key value: list of (Shape element, properties)
+            for e, properties in self._shape_properties(dict()):
+                value = properties.get(key, {}).get('Value')
+                if value is not None:
+                    index.setdefault(value, list()).append((e, properties))
+
+            unmatched = list()
+            for row in rows:
+                row = {(name[5:] if name.startswith('Prop.') else name): value for name, value in row.items()}
+                shapes = index.get(None if row.get(key) is None else str(row.get(key)))
+                if not shapes:
+                    unmatched.append(row.get(key))
+                    continue
+                for e, properties in shapes:
+                    for name, value in row.items():
+                        if name != key:
+                            VisioFile._set_property_value(e, name, str(value), inherited=name in properties)
+            return unmatched
+
+        def _property_rows(self, master_properties: dict):
+            # yield (shape ID, {property name: {cell name: value}}) of each shape with properties
+            for e, properties in self._shape_properties(master_properties):
+                if properties:
+                    yield e.attrib.get('ID'), properties
+
+        def _shape_properties(self, master_properties: dict):
+            # yield (Shape element, {property name: {cell name: value}}) of each shape, in one walk of page
+            def shape_properties(shapes: Element, parent_master_page_ID: Optional[str]):
+                for e in shapes.findall(f"{namespace}Shape"):
+                    master_page_ID = e.attrib.get('Master', parent_master_page_ID)
+                    properties = dict()
+                    if master_page_ID is not None:
+                        properties = dict(self.vis._master_properties(master_page_ID, e.attrib.get('MasterShape'),
+                                                                      master_properties))
+                    VisioFile._update_properties(properties, e)
+                    yield e, properties
+                    for sub_shapes in e.findall(f"{namespace}Shapes"):
+                        yield from shape_properties(sub_shapes, master_page_ID)
+
+            for shapes in self.xml.getroot().findall(f"{namespace}Shapes"):
+                yield from shape_properties(shapes, None)
+
+
+class JinjaRenderer:
+    """Render a Jinja template VisioFile repeatedly, as context values change
+
+    The first call to :meth:`render` renders each page as :meth:`VisioFile.jinja_render_vsdx` does, and records which
+    context variables each page, and each shape's text and `{% set self.x = ... %}` statements depend on.
+    Later calls re-render only shapes, or pages, that depend on variables whose values have changed, and only pages
+    changed since the last call to :meth:`save` are written when saving.
+
+    Shapes inside a `{% for %}` loop or `{% showif %}` statement are re-rendered with the whole page.
+
+    :param vis: the template VisioFile, which is rendered in place
+    :type vis: :class:`VisioFile`
+    """
+    class _PageState:
+        def __init__(self, page: VisioFile.Page, element: Element):
+            self.page = page
+            self.element = element  # Page element in pages.xml, kept so that a hidden page can be shown again
+            self.visible = True
+            self.show_if = None  # expression from page name {% showif %} statement
+            self.show_if_variables = frozenset()
+            self.source = None  # preprocessed source, or None for a static page
+            self.template = None
+            self.loop_shape_ids = list()
+            self.set_selfs = list()
+            self.variables = set()  # variables that require the whole page to be re-rendered
+            self.shapes = dict()  # shape ID: _ShapeState for each shape that can be re-rendered on its own
+            self.shape_elements = None  # shape ID: rendered Shape Element, built when first needed
+
+    class _ShapeState:
+        def __init__(self, shape_id: str, text_source: Optional[str], set_selfs: list, values: dict, variables: set):
+            self.shape_id = shape_id
+            self.text_template = jinja_env.from_string(text_source) if text_source else None
+            self.set_selfs = set_selfs  # list of (property, value)
+            self.values = values  # template value of each property set by set_selfs
+            self.variables = variables
+
+    def __init__(self, vis: VisioFile):
+        vis._check_writable()
+        self.vis = vis
+        self.context = None  # copy of context last rendered
+        self.dirty_pages = set()  # pages changed since last saved
+        self._pages = list()
+        for page, element in zip(vis.pages, vis.pages_xml.getroot()):
+            state = JinjaRenderer._PageState(page, element)
+            show_ifs = _showif_re.findall(page.name)
+            if show_ifs:
+                state.show_if = show_ifs[-1]
+                state.show_if_variables = jinja_expression_variables(state.show_if)
+                # remove jinja statement from page name
+                page.set_name(page.name.replace(_statement_re.match(page.name)[0], ''))
+            if page.contains_jinja():
+                self._prepare_page(state)
+            self._pages.append(state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _prepare_page(self, state: JinjaRenderer._PageState):
+        page = state.page
+        free_shape_ids = set()  # shapes not in any loop or showif
+        for shapes in page.shapes:  # type: VisioFile.Shape
+            JinjaRenderer._find_free_shapes(shapes, False, free_shape_ids)
+
+        state.source, state.loop_shape_ids, state.set_selfs = self.vis._jinja_prepare_page(page)
+        state.template = jinja_env.from_string(state.source)
+        if _declaration_re.search(state.source):
+            free_shape_ids = set()  # a shape may use variables set in another shape, so always render whole page
+
+        # record text source and set self statements of each free shape, to be rendered on their own
+        page_set_selfs = list()
+        for shape_id, property_name, value in state.set_selfs:
+            if shape_id not in free_shape_ids:
+                page_set_selfs.append((shape_id, property_name, value))
+        prepared = copy.deepcopy(page.xml.getroot())
+        for e in prepared.iter(f"{namespace}Shape"):
+            shape_id = e.attrib.get('ID')
+            if shape_id not in free_shape_ids:
+                continue
+            text_source = None
+            text_element = e.find(f"{namespace}Text")
+            if text_element is not None and any(marker in ''.join(text_element.itertext()) for marker in jinja_markers):
+                text_source = VisioFile.unescape_jinja_statements(ET.tostring(text_element, encoding='unicode'))
+                text_element.clear()  # so that only page level variables remain in prepared source
+            set_selfs = [(p, v) for i, p, v in state.set_selfs if i == shape_id]
+            if text_source is None and not set_selfs:
+                continue
+            variables = set(meta.find_undeclared_variables(jinja_env.parse(text_source))) if text_source else set()
+            values = dict()
+            if set_selfs:
+                shape = page.find_shape_by_id(shape_id)
+                for property_name, value in set_selfs:
+                    values.setdefault(property_name, shape.__getattribute__(property_name))
+                    variables.update(jinja_expression_variables(_self_ref_re.sub('vsdx_self.', value)))
+            variables.discard('vsdx_self')
+            state.shapes[shape_id] = JinjaRenderer._ShapeState(shape_id, text_source, set_selfs, values, variables)
+
+        source = VisioFile.unescape_jinja_statements(ET.tostring(prepared, encoding='unicode'))
+        state.variables = set(meta.find_undeclared_variables(jinja_env.parse(source)))
+        for _, _, value in page_set_selfs:
+            state.variables.update(jinja_expression_variables(_self_ref_re.sub('vsdx_self.', value)))
+        state.variables.discard('vsdx_self')
+
+    @staticmethod
+    def _find_free_shapes(shape: VisioFile.Shape, in_statement: bool, free_shape_ids: set):
+        for s in shape.sub_shapes():  # type: VisioFile.Shape
+            if s.tag != f"{namespace}Shape":
+                continue
+            text = s.text
+            shape_in_statement = in_statement or bool(_for_loop_re.search(text) or _showif_re.search(text))
+            if not shape_in_statement:
+                free_shape_ids.add(s.ID)
+            JinjaRenderer._find_free_shapes(s, shape_in_statement, free_shape_ids)
+
+    def render(self, context: dict) -> List[VisioFile.Page]:
+        """Render the template with context, re-rendering only what depends on values changed since last rendered
+
+        :param context: A dictionary containing values that can be accessed by the Jinja processor
+        :type context: dict
+
+        :return: list of the :class:`VisioFile.Page` objects changed
+        """
+        changed = None  # None if everything must be rendered
+        if self.context is not None:
+            missing = object()
+            changed = set(key for key in set(context) | set(self.context)
+                          if context.get(key, missing) != self.context.get(key, missing))
+
+        rendered_pages = list()
+        for state in self._pages:
+            render_page = changed is None or bool(changed & state.variables)
+            if state.show_if and (changed is None or changed & state.show_if_variables):
+                value = str(compile_jinja_expression(state.show_if)(context))
+                visible = value not in ['False', '0', '', '()', '[]', '{}']
+                if visible != state.visible:
+                    self._set_visible(state, visible)
+                    render_page = render_page or visible  # page content may be out of date
+            if not state.visible or state.source is None:
+                continue
+
+            if render_page:
+                output = state.template.render(context).encode('utf-8')
+                self.vis._jinja_finish_page(state.page, output, state.loop_shape_ids, state.set_selfs, context)
+                state.shape_elements = None
+                rendered_pages.append(state.page)
+            else:
+                shape_states = [shape_state for shape_state in state.shapes.values() if changed & shape_state.variables]
+                for shape_state in shape_states:
+                    self._render_shape(state, shape_state, context)
+                if shape_states:
+                    rendered_pages.append(state.page)
+
+        self.dirty_pages.update(rendered_pages)
+        self.context = copy.deepcopy(context)
+        return rendered_pages
+
+    def _render_shape(self, state: JinjaRenderer._PageState, shape_state: JinjaRenderer._ShapeState, context: dict):
+        if state.shape_elements is None:
+            state.shape_elements = {e.attrib.get('ID'): e for e in state.page.xml.getroot().iter(f"{namespace}Shape")}
+        element = state.shape_elements[shape_state.shape_id]
+        if shape_state.text_template:
+            text_element = element.find(f"{namespace}Text")
+            new_text_element = ET.fromstring(shape_state.text_template.render(context))
+            new_text_element.tail = text_element.tail
+            element[list(element).index(text_element)] = new_text_element
+        if shape_state.set_selfs:
+            shape = state.page.find_shape_by_id(shape_state.shape_id)
+            for property_name, value in shape_state.values.items():
+                shape.__setattr__(property_name, value)  # restore template value, used by any self references
+            for property_name, value in shape_state.set_selfs:
+                VisioFile.jinja_apply_set_self(shape, property_name, value, context)
+
+    def _set_visible(self, state: JinjaRenderer._PageState, visible: bool):
+        # remove or re-insert page, preserving the order of pages in template
+        if visible:
+            index = sum(1 for s in self._pages[:self._pages.index(state)] if s.visible)
+            self.vis.pages_xml.getroot().insert(index, state.element)
+            self.vis.pages.insert(index, state.page)
+            self.vis._pages_changed()
+            if self.vis.app_xml:
+                self.vis._add_page_to_app_xml(state.page.name, index)
+        else:
+            self.vis.remove_page_by_index(state.page.index_num)
+            self.dirty_pages.discard(state.page)
+        state.visible = visible
+
+    def save(self, new_filename: str):
+        """Save the rendered VisioFile as new vsdx file, writing only pages changed since last saved
+
+        :param new_filename: path to save vsdx file
+        :type new_filename: str
+        """
+        self.vis._save_vsdx(new_filename, pages=[p for p in self.vis.pages if p in self.dirty_pages])
+        self.dirty_pages = set()
+
+    def close(self):
+        self.vis.close_vsdx()
+
+
+class RenderCache:
+    """On disk cache of rendered vsdx files, so that rendering a template again with the same context is a file copy
+
+    Entries are keyed by a hash of the template file contents and a hash of the context, which is compared by its
+    JSON representation with keys sorted. When the cache directory exceeds `max_size` bytes, the least recently used
+    entries are removed.
+
+    :param directory: directory to store cached files in, created if it does not exist
+    :type directory: str
+    :param max_size: maximum total size in bytes of cached files
+    :type max_size: int, default 256MB
+
+    :param hits: number of renders served from the cache
+    :param misses: number of renders that were not in the cache
+    """
+    def __init__(self, directory: str, max_size: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._template_hashes = dict()  # (filename, mtime, size): hash, so unchanged templates are only read once
+        os.makedirs(directory, exist_ok=True)
+
+    def template_hash(self, filename: str) -> str:
+        stat = os.stat(filename)
+        stat_key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        if stat_key not in self._template_hashes:
+            with open(filename, 'rb') as f:
+                self._template_hashes[stat_key] = hashlib.sha256(f.read()).hexdigest()
+        return self._template_hashes[stat_key]
+
+    @staticmethod
+    def context_hash(context: dict) -> str:
+        # values that are not JSON types, such as dates, are represented by repr()
+        canonical = json.dumps(context, sort_keys=True, separators=(',', ':'), default=repr)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def key(self, filename: str, context: dict) -> str:
+        return f"{self.template_hash(filename)[:32]}-{RenderCache.context_hash(context)[:32]}"
+
+    def jinja_render_vsdx(self, filename: str, context: dict, new_filename: str, workers: Optional[int] = None) -> str:
+        """Render template file with context and save as new_filename, or copy the cached result of an earlier render
+
+        :param filename: the template vsdx file
+        :type filename: str
+        :param context: A dictionary containing values that can be accessed by the Jinja processor
+        :type context: dict
+        :param new_filename: path to save vsdx file
+        :type new_filename: str
+        :param workers: number of processes used to render pages concurrently, passed to :meth:`VisioFile.jinja_render_vsdx`
+        :type workers: int, optional
+
+        :return: filename of saved vsdx file
+        """
+        if new_filename[-5:] != '.vsdx':
+            new_filename += '.vsdx'
+        cached_filename = os.path.join(self.directory, self.key(filename, context) + '.vsdx')
+        if os.path.exists(cached_filename):
+            self.hits += 1
+            os.utime(cached_filename)  # mark as recently used
+            shutil.copyfile(cached_filename, new_filename)
+            return new_filename
+
+        self.misses += 1
+        with VisioFile(filename) as vis:
+            vis.jinja_render_vsdx(context, workers=workers)
+            vis.save_vsdx(new_filename)
+        # copy to temporary file first, so that a partly written file is never used
+        temp_filename = cached_filename + '.tmp'
+        shutil.copyfile(new_filename, temp_filename)
+        os.replace(temp_filename, cached_filename)
+        self._evict()
+        return new_filename
+
+    def _evict(self):
+        entries = list()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.vsdx'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):  # least recently used first
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        """Remove all cached files, and reset hits and misses counters"""
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.vsdx'):
+                os.remove(entry.path)
+        self.hits = 0
+        self.misses = 0
+
+
+class AsyncConfig:
+    """Executor and concurrency limit used by :class:`AsyncVisioFile`
+
+    At most `max_concurrency` blocking operations run at the same time, across all AsyncVisioFile objects opened with
+    the same AsyncConfig, so a burst of requests waits rather than unzipping every file at once.
+
+    :param executor: a ThreadPoolExecutor or ProcessPoolExecutor, or None for the event loop's default executor
+    :type executor: concurrent.futures.Executor, optional
+    :param max_concurrency: maximum number of blocking operations running at the same time, default to cpu count
+    :type max_concurrency: int, optional
+    """
+    def __init__(self, executor=None, max_concurrency: Optional[int] = None):
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, not {max_concurrency}")
+        self._executor = executor
+        self._max_concurrency = max_concurrency or os.cpu_count() or 4
+        self._semaphores = weakref.WeakKeyDictionary()  # event loop: asyncio.Semaphore
+
+    @property
+    def executor(self):
+        return self._executor
+
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    @property
+    def uses_processes(self) -> bool:
+        # a VisioFile can't be shared with a process pool, so each file is opened, rendered and saved in one call
+        return isinstance(self._executor, ProcessPoolExecutor)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self._max_concurrency)
+        async with semaphore:
+            return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+
+_default_async_config = AsyncConfig()
+
+
+class AsyncVisioFile:
+    """asyncio wrapper of :class:`VisioFile`, which opens, renders and saves without blocking the event loop
+
+    Blocking work runs in the executor of the :class:`AsyncConfig` passed to :meth:`open`. With a thread pool, or the
+    event loop's default executor, the VisioFile is opened by :meth:`open` and shared with the pool. With a process
+    pool, the file is kept as a path or bytes and :meth:`render` only records the context, then :meth:`save` opens,
+    renders and saves the file in one call in a worker process, so `vis` is None and the context must be picklable.
+
+    :param vis: the opened VisioFile, use :meth:`open` to create an AsyncVisioFile
+    :type vis: :class:`VisioFile`, or None if opened with a process pool
+    :param config: executor and concurrency limit
+    :type config: :class:`AsyncConfig`, optional
+    """
+    def __init__(self, vis: Optional[VisioFile], config: Optional[AsyncConfig] = None):
+        self.vis = vis
+        self.config = config or _default_async_config
+        self._source = None  # path or bytes of vsdx file, when opened with a process pool
+        self._debug = False
+        self._renders = list()  # (context, workers) to render when saved, when opened with a process pool
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @classmethod
+    async def open(cls, source, debug: bool = False, config: Optional[AsyncConfig] = None) -> AsyncVisioFile:
+        """Open a vsdx file
+
+        :param source: path of vsdx file, vsdx file contents, or binary file object
+        :type source: str, bytes or file object
+        :param debug: enable/disable debugging
+        :type debug: bool, default to False
+        :param config: executor and concurrency limit, default to the event loop's default executor and cpu count
+        :type config: :class:`AsyncConfig`, optional
+
+        :return: :class:`AsyncVisioFile`
+        """
+        config = config or _default_async_config
+        if config.uses_processes:
+            doc = cls(None, config)
+            if not isinstance(source, (str, bytes)):
+                source = bytes(source) if isinstance(source, bytearray) else \
+                    await asyncio.get_running_loop().run_in_executor(None, source.read)
+            doc._source, doc._debug = source, debug
+            return doc
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+        return cls(await config._run(VisioFile, source, debug=debug), config)
+
+    async def render(self, context: dict, workers: Optional[int] = None):
+        """Render the VisioFile as a Jinja template, see :meth:`VisioFile.jinja_render_vsdx`
+
+        :param context: A dictionary containing values that can be accessed by the Jinja processor
+        :type context: dict
+        :param workers: number of processes used to render pages concurrently (context must be picklable)
+        :type workers: int, optional
+        """
+        if self.config.uses_processes:
+            self._renders.append((context, workers))
+            return
+        await self.config._run(self.vis.jinja_render_vsdx, context, workers=workers)
+
+    async def save(self, target=None) -> Optional[bytes]:
+        """Save as new vsdx file and close, see :meth:`VisioFile.save_vsdx`
+
+        :param target: path to save vsdx file, binary file object to write to, or None to return file contents
+        :type target: str, file object or None
+
+        :return: vsdx file contents if target is None
+        """
+        if not self.config.uses_processes:
+            return await self.config._run(_save_to_target, self.vis, target)
+        contents = await self.config._run(_render_and_save, self._source, self._debug, self._renders,
+                                          target if isinstance(target, str) else None)
+        if contents is not None and target is not None:
+            await asyncio.get_running_loop().run_in_executor(None, target.write, contents)
+            return
+        return contents
+
+    async def close(self):
+        if self.config.uses_processes:
+            self._source, self._renders = None, list()
+            return
+        await self.config._run(self.vis.close_vsdx)
+
+
+def _save_to_target(vis: VisioFile, target) -> Optional[bytes]:
+    # save to path or file object, or return file contents if target is None
+    if isinstance(target, str):
+        vis.save_vsdx(target)
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, f"{_file_stem(vis.filename)}.vsdx")
+        vis.save_vsdx(filename)
+        with open(filename, 'rb') as f:
+            if target is None:
+                return f.read()
+            shutil.copyfileobj(f, target)
+    finally:
+        shutil.rmtree(directory)
+
+
+def _render_and_save(source, debug: bool, renders: list, filename: Optional[str]) -> Optional[bytes]:
+    # open, render and save a vsdx file in a worker process of AsyncVisioFile, returning its contents if not filename
+    with VisioFile(io.BytesIO(source) if isinstance(source, bytes) else source, debug=debug) as vis:
+        for context, workers in renders:
+            vis.jinja_render_vsdx(context, workers=workers)
+        return _save_to_target(vis, filename)
+
+
+class ShapeRecord:
+    """Shape data read by :func:`scan`
+
+    :param page: name of the page containing the shape
+    :param ID: shape ID
+    :param parent_ID: ID of the group shape containing the shape, or None
+    :param master_page_ID: ID of the master page, from the shape or the group containing it, or None
+    :param master_shape_ID: ID of the shape in the master page, or None
+    :param text: text of the shape, not including any text inherited from its master
+    :param cells: dict of cell name: value, for the cells requested
+    :param properties: dict of property name: dict of cell name: value, such as {'Value': 'A1', 'Label': 'Rack'}
+    """
+    __slots__ = ('page', 'ID', 'parent_ID', 'master_page_ID', 'master_shape_ID', 'text', 'cells', 'properties')
+
+    def __init__(self, page: str, ID: str, parent_ID: Optional[str], master_page_ID: Optional[str],
+                 master_shape_ID: Optional[str]):
+        self.page = page
+        self.ID = ID
+        self.parent_ID = parent_ID
+        self.master_page_ID = master_page_ID
+        self.master_shape_ID = master_shape_ID
+        self.text = ''
+        self.cells = dict()
+        self.properties = dict()
+
+    def __repr__(self):
+        return f"<ShapeRecord page={self.page} ID={self.ID} text='{self.text}' >"
+
+
+def scan(filename, cells: tuple = ('PinX', 'PinY', 'Width', 'Height')) -> Iterator[ShapeRecord]:
+    """Read the shapes of each page of a vsdx file, without extracting it or building an ElementTree of each page
+
+    Pages are parsed as they are read from the vsdx file, and each shape is discarded once its record is created,
+    so memory use does not depend on the size of pages. Shapes are returned in document order, with each group
+    shape before the shapes it contains.
+
+    :param filename: the vsdx file to scan
+    :type filename: str, or binary file object
+    :param cells: names of cells to include in each :class:`ShapeRecord`
+    :type cells: tuple of str
+
+    :return: generator of :class:`ShapeRecord`
+    """
+    r_id = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+    shape_tag, shapes_tag, cell_tag = f'{namespace}Shape', f'{namespace}Shapes', f'{namespace}Cell'
+    text_tag, section_tag, row_tag = f'{namespace}Text', f'{namespace}Section', f'{namespace}Row'
+    # elements are removed from these parents once read, so that memory use stays constant
+    container_tags = {f'{namespace}PageContents', f'{namespace}Connects', shapes_tag, shape_tag}
+    cells = set(cells)
+    with zipfile.ZipFile(filename, 'r') as zip_ref:
+        rels = ET.fromstring(zip_ref.read('visio/pages/_rels/pages.xml.rels'))
+        targets = {rel.attrib['Id']: rel.attrib['Target'] for rel in rels}
+        pages = ET.fromstring(zip_ref.read('visio/pages/pages.xml'))
+        for page in pages:
+            page_name = page.attrib['Name']
+            part_name = posixpath.join('visio/pages', targets[page.find(f'{namespace}Rel').attrib[r_id]])
+            with zip_ref.open(part_name) as f:
+                elements = list()  # elements from page root to current element
+                records = list()  # record of each Shape element in elements
+                returned = list()  # whether each record in records has been returned
+                for event, e in ET.iterparse(f, events=('start', 'end')):
+                    if event == 'start':
+                        if e.tag == shape_tag:
+                            parent = records[-1] if records else None
+                            master_page_ID = e.attrib.get('Master') or (parent.master_page_ID if parent else None)
+                            records.append(ShapeRecord(page_name, e.attrib.get('ID'), parent.ID if parent else None,
+                                                       master_page_ID, e.attrib.get('MasterShape')))
+                            returned.append(False)
+                        elif e.tag == shapes_tag and elements and elements[-1].tag == shape_tag:
+                            # group shape data is all before its sub shapes, so return group before sub shapes
+                            returned[-1] = True
+                            yield records[-1]
+                        elements.append(e)
+                        continue
+
+                    elements.pop()
+                    parent = elements[-1] if elements else None
+                    if parent is not None and parent.tag in container_tags:
+                        parent.remove(e)
+                    if e.tag == shape_tag:
+                        record = records.pop()
+                        if not returned.pop():
+                            yield record
+                    elif parent is None or parent.tag != shape_tag:
+                        continue  # only elements directly in a Shape are needed
+                    elif e.tag == cell_tag:
+                        if e.attrib.get('N') in cells:
+                            records[-1].cells[e.attrib['N']] = e.attrib.get('V')
+                    elif e.tag == text_tag:
+                        records[-1].text = ''.join(e.itertext())
+                    elif e.tag == section_tag and e.attrib.get('N') == 'Property':
+                        for row in e.findall(row_tag):
+                            records[-1].properties[row.attrib.get('N')] = {c.attrib.get('N'): c.attrib.get('V')
+                                                                           for c in row.findall(cell_tag)}
+
+
+def _compress_type(filename: str, compression: int) -> int:
+    # compression used to save a part - already compressed media is always stored
+    if compression == zipfile.ZIP_STORED or os.path.splitext(filename)[1].lower() in compressed_extensions:
+        return zipfile.ZIP_STORED
+    return compression
+
+
+def _compress_file(filename: str, compression: int, level: int) -> (int, int, int, bytes):
+    """Read and compress a file, returning (size, crc, compress type, compressed data)"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if _compress_type(filename, compression) == zipfile.ZIP_STORED:
+        return len(data), zlib.crc32(data), zipfile.ZIP_STORED, data
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)  # raw deflate stream, as stored in zip files
+    return len(data), zlib.crc32(data), zipfile.ZIP_DEFLATED, compressor.compress(data) + compressor.flush()
+
+
+def _write_compressed(zip_out: zipfile.ZipFile, arcname: str, filename: str, future: Future):
+    size, crc, compress_type, compressed = future.result()
+    info = zipfile.ZipInfo.from_file(filename, arcname)
+    info.compress_type = compress_type
+    info.file_size = size
+    info.CRC = crc
+    _write_raw_member(zip_out, info, compressed)
+
+
+def _set_compress_level(info: zipfile.ZipInfo, level: int):
+    # ZipInfo.compress_level is public from Python 3.13, earlier versions read _compresslevel when writing
+    if sys.version_info >= (3, 13):
+        info.compress_level = level
+    else:
+        info._compresslevel = level
+
+
+def _write_file(zip_out: zipfile.ZipFile, arcname: str, filename: str, compression: int, level: int):
+    """Write a file to zip file with the public zipfile API, in chunks"""
+    info = zipfile.ZipInfo.from_file(filename, arcname)
+    info.compress_type = _compress_type(filename, compression)
+    _set_compress_level(info, level)
+    with open(filename, 'rb') as src, zip_out.open(info, 'w', force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def _recompress_member(zip_in: zipfile.ZipFile, zip_out: zipfile.ZipFile, source: zipfile.ZipInfo,
+                       compress_type: int, level: int):
+    """Copy a zip file member to another zip file with the public zipfile API, in chunks, compressing it again"""
+    info = zipfile.ZipInfo(source.filename, source.date_time)
+    info.compress_type = compress_type
+    info.external_attr = source.external_attr
+    info.create_system = source.create_system
+    _set_compress_level(info, level)
+    with zip_in.open(source) as src, zip_out.open(info, 'w', force_zip64=source.file_size > zipfile.ZIP64_LIMIT) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def _zip_raw_access(zip_file: zipfile.ZipFile) -> bool:
+    """Check whether compressed data can be written to a zip file directly, using private zipfile internals
+
+    zipfile has no public API to write data that is already compressed, which is needed to compress parts in
+    parallel threads and to copy parts from the source file without decompressing them. _write_raw_member() and
+    _copy_raw_member() write local file headers and data themselves, and update the ZipFile's central directory
+    records, as ZipFile.write() does internally. This is only done on the Python versions it is tested with, since
+    a change to these internals could otherwise write a corrupt file. On other versions parts are written with
+    the public ZipFile.open() instead, which is slower but gives the same vsdx file
+    """
+    return raw_zip_versions[0] <= sys.version_info[:2] <= raw_zip_versions[1] and \
+        all(hasattr(zipfile, name) for name in ('_FH_FILENAME_LENGTH', '_FH_EXTRA_FIELD_LENGTH',
+                                                'structFileHeader', 'sizeFileHeader')) and \
+        all(hasattr(zip_file, name) for name in ('_writecheck', '_didModify', 'fp', 'start_dir',
+                                                 'filelist', 'NameToInfo'))
+
+
+def _write_raw_member(zip_out: zipfile.ZipFile, info: zipfile.ZipInfo, data: bytes):
+    """Write already compressed data to zip file - only if _zip_raw_access()"""
+    info.compress_size = len(data)
+    _write_raw_header(zip_out, info)
+    zip_out.fp.write(data)
+    zip_out.start_dir = zip_out.fp.tell()
+
+
+def _write_raw_header(zip_out: zipfile.ZipFile, info: zipfile.ZipInfo):
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    info.header_offset = zip_out.fp.tell()
+    zip_out._writecheck(info)
+    zip_out._didModify = True
+    zip_out.filelist.append(info)
+    zip_out.NameToInfo[info.filename] = info
+    zip_out.fp.write(info.FileHeader(zip64))
+
+
+def _copy_raw_member(zip_in: zipfile.ZipFile, zip_out: zipfile.ZipFile, source: zipfile.ZipInfo):
+    """Copy compressed data of a zip file member to another zip file, in chunks, without decompressing it - only if
+    _zip_raw_access()"""
+    zip_in.fp.seek(source.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, zip_in.fp.read(zipfile.sizeFileHeader))
+    zip_in.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    info = zipfile.ZipInfo(source.filename, source.date_time)
+    info.compress_type = source.compress_type
+    info.external_attr = source.external_attr
+    info.create_system = source.create_system
+    info.flag_bits = source.flag_bits & 0x800  # keep utf-8 filename flag, sizes are in header rather than descriptor
+    info.CRC = source.CRC
+    info.file_size = source.file_size
+    info.compress_size = source.compress_size
+    _write_raw_header(zip_out, info)
+    remaining = source.compress_size
+    while remaining > 0:
+        chunk = zip_in.fp.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for {source.filename}")
+        zip_out.fp.write(chunk)
+        remaining -= len(chunk)
+    zip_out.start_dir = zip_out.fp.tell()
+
+
+def _is_page_part(name: str) -> bool:
+    # page or master page part, or its relationships part, but not pages.xml or masters.xml which list them
+    return name.startswith(('visio/pages/', 'visio/masters/')) and \
+        posixpath.basename(name) not in ('pages.xml', 'pages.xml.rels', 'masters.xml', 'masters.xml.rels')
+
+
+def _is_parsed_part(name: str) -> bool:
+    # parts read or written by VisioFile, which are extracted when opened
+    return name.endswith(('.xml', '.rels')) or name.startswith(f'{compiled_template_dir}/')
+
+
+def _file_stem(filename) -> str:
+    # file name without directory or extension, of a path or file object
+    name = filename if isinstance(filename, str) else getattr(filename, 'name', None)
+    return os.path.basename(name).rsplit('.', 1)[0] if isinstance(name, str) else 'vsdx'
+
 
 def file_to_xml(filename: str) -> ET.ElementTree:
     """Import a file as an ElementTree"""
@@ -1403,6 +3021,25 @@ def file_to_xml(filename: str) -> ET.ElementTree:
         pass  # return None
 
 
+def _copy_xml(xml: Optional[ET.ElementTree]) -> Optional[ET.ElementTree]:
+    return ET.ElementTree(copy.deepcopy(xml.getroot())) if xml is not None else None
+
+
+def _copy_directory(src: str, dst: str):
+    """Copy extracted vsdx files, linking files that are never rewritten, such as media"""
+    for root, _, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            if not name.endswith(('.xml', '.rels')):
+                try:
+                    os.link(os.path.join(root, name), os.path.join(target, name))
+                    continue
+                except OSError:
+                    pass  # links not supported, so copy
+            shutil.copyfile(os.path.join(root, name), os.path.join(target, name))
+
+
 def xml_to_file(xml: ET.ElementTree, filename: str):
     """Save an ElementTree to a file"""
     xml.write(filename)
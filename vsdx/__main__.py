@@ -0,0 +1,135 @@
+"""Command line tools for vsdx files
+
+Usage: python -m vsdx extract [-h] [--output OUTPUT] [--format {jsonl,csv}] [--workers WORKERS]
+                              [--progress PROGRESS] [--cells CELLS] path [path ...]
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from typing import List, Optional
+
+from vsdx import scan
+
+default_cells = ('PinX', 'PinY', 'Width', 'Height')  # geometry cells included in each record
+
+
+def find_files(paths: List[str]) -> List[str]:
+    """Return the vsdx files in each path, which may be a file, a directory to search, or a glob pattern"""
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '**', '*.vsdx'), recursive=True)))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            files.extend(sorted(glob.glob(path, recursive=True)))
+    return list(dict.fromkeys(files))  # remove duplicates, keeping order
+
+
+def extract_file(filename: str, cells: tuple) -> List[dict]:
+    """Return a record for each shape in a vsdx file, or a single error record if the file can't be read"""
+    try:
+        return [{'file': filename, 'page': r.page, 'id': r.ID, 'parent_id': r.parent_ID,
+                 'master_page_id': r.master_page_ID, 'master_shape_id': r.master_shape_ID, 'text': r.text,
+                 'cells': r.cells, 'properties': r.properties}
+                for r in scan(filename, cells=cells)]
+    except Exception as e:
+        return [{'file': filename, 'error': f"{type(e).__name__}: {e}",
+                 'traceback': traceback.format_exc(limit=3)}]
+
+
+class RecordWriter:
+    """Write shape records as JSON Lines, or as CSV with a column for each cell and properties as JSON"""
+    def __init__(self, out, output_format: str, cells: tuple, write_header: bool):
+        self.out = out
+        self.output_format = output_format
+        if output_format == 'csv':
+            fieldnames = ['file', 'page', 'id', 'parent_id', 'master_page_id', 'master_shape_id', 'text',
+                          *cells, 'properties', 'error']
+            self.csv_writer = csv.DictWriter(out, fieldnames=fieldnames, extrasaction='ignore')
+            if write_header:
+                self.csv_writer.writeheader()
+
+    def write(self, record: dict):
+        if self.output_format == 'csv':
+            row = dict(record)
+            row.update(record.get('cells', {}))
+            if 'properties' in record:
+                row['properties'] = json.dumps(record['properties'])
+            self.csv_writer.writerow(row)
+        else:
+            self.out.write(json.dumps(record) + '\n')
+
+
+def extract(args: argparse.Namespace) -> int:
+    cells = tuple(c for c in args.cells.split(',') if c)
+    files = find_files(args.path)
+
+    # files already extracted are listed in progress file, and skipped when run again
+    done = set()
+    if args.progress and os.path.exists(args.progress):
+        with open(args.progress, encoding='utf-8') as f:
+            done = set(line.rstrip('\n') for line in f if line.strip())
+    files = [f for f in files if f not in done]
+
+    if args.output:
+        write_header = not (done and os.path.exists(args.output) and os.path.getsize(args.output))
+        out = open(args.output, 'a' if done else 'w', encoding='utf-8', newline='')
+    else:
+        write_header = True
+        out = sys.stdout
+    progress = open(args.progress, 'a', encoding='utf-8') if args.progress else None
+    writer = RecordWriter(out, args.format, cells, write_header)
+
+    errors = 0
+    try:
+        with (ProcessPoolExecutor(max_workers=args.workers) if args.workers != 1 else nullcontext()) as executor:
+            if executor:
+                results = executor.map(extract_file, files, [cells] * len(files), chunksize=4)
+            else:
+                results = (extract_file(f, cells) for f in files)
+            for filename, records in zip(files, results):
+                for record in records:
+                    errors += 'error' in record
+                    writer.write(record)
+                out.flush()
+                if progress:
+                    # record progress only once file's records are written
+                    progress.write(filename + '\n')
+                    progress.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if progress:
+            progress.close()
+    print(f"{len(files)} files extracted, {errors} errors, {len(done)} skipped", file=sys.stderr)
+    return 1 if errors else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m vsdx', description='Tools for vsdx files')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    extract_parser = commands.add_parser('extract', help='extract shape text, data properties and geometry cells')
+    extract_parser.add_argument('path', nargs='+', help='vsdx file, directory to search, or glob pattern')
+    extract_parser.add_argument('--output', '-o', help='output file, default is stdout')
+    extract_parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='output format')
+    extract_parser.add_argument('--workers', type=int, default=None,
+                                help='number of processes, default is number of CPUs')
+    extract_parser.add_argument('--progress', help='file listing files done, which are skipped if run again')
+    extract_parser.add_argument('--cells', default=','.join(default_cells),
+                                help=f"comma separated cell names, default is {','.join(default_cells)}")
+    extract_parser.set_defaults(func=extract)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())